@@ -1,7 +1,20 @@
+import os
+
 import pandas as pd
 import streamlit as st
 from streamlit_option_menu import option_menu as option_menu
-from data_processing import process_data
+from data_processing import PROCESSING_VERSION, LeadsProcessor, make_read_only
+from data_sync import LeadsSync
+from dataset_cache import clear_dataset_caches, shared_state
+from feature_ages import FeatureAges
+from gazetteer import load_gazetteer
+from lead_cube import LeadCubes
+from filter_index import selection_cache
+from refresher import Dataset, DatasetRefresher
+from search import SearchIndex
+from sheets import SheetsBackend, LocalSheetBackend
+from snapshot import frame_version, read_snapshot, read_snapshot_meta, write_snapshot
+from spatial_index import SpatialIndex
 from streamlit_gsheets import GSheetsConnection
 from auth import authenticate_user, handle_authentication_status
 from css.streamlit_ui import main_styles, inner_styles
@@ -23,30 +36,106 @@ with open("css/style.css") as css:
 st.markdown(main_styles, unsafe_allow_html=True)
 
 # ------------------------------- Data -----------------------------------------
-# data = pd.read_csv("data/df.csv")
-# users_df = pd.read_csv("data/users2.csv")
+# Set LEADS_DATA_DIR to a folder with leads.csv / users.csv to run without Google Sheets
+LOCAL_DATA_DIR = os.environ.get("LEADS_DATA_DIR")
+SNAPSHOT_PATH = os.environ.get("LEADS_SNAPSHOT_PATH", "data/leads_snapshot.parquet")
 
 # ------------------------------- Data Loading ---------------------------------
-conn = st.connection("gsheets", type=GSheetsConnection)
-
-@st.cache_data(ttl=60)
-def load_data():
-    data = conn.read(worksheet='leads')
-    users_df = conn.read(worksheet='users')
-    return data, users_df
-
-# Fetch data
-data, users_df = load_data()
+# All sheet access goes through the backend, which coalesces concurrent reads and backs off on rate limits
+if LOCAL_DATA_DIR:
+    backend = LocalSheetBackend(LOCAL_DATA_DIR)
+else:
+    backend = SheetsBackend(st.connection("gsheets", type=GSheetsConnection))
+
+def refresh_leads(leads_sync, users_sync, processor, current):
+    """
+    Pulls new or changed leads, processes them and refreshes the local snapshot.
+    The users worksheet has its own sync, so it is only read again when the
+    sheet's modification stamp moved.
+    The processed frame is keyed on the content hash of the raw sheet and the
+    stamp of the gazetteer table, so it is only rebuilt when either actually
+    changed, and then only the rows of the sync delta are processed (see
+    LeadsProcessor). An empty delta keeps the current dataset without hashing
+    the sheet.
+    """
+    delta = leads_sync.sync()
+    raw = leads_sync.frame
+    users_sync.sync()
+    users_df = users_sync.frame
+    gazetteer = load_gazetteer().stamp
+    if current is not None and not len(delta.changed) and not len(delta.removed_ids):
+        processor.adopt(current.data, raw, delta, gazetteer=gazetteer)
+        return current._replace(users=users_df)
+
+    version = frame_version(raw, salt=gazetteer)
+    if current is not None and current.version == version:
+        processor.adopt(current.data, raw, delta, gazetteer=gazetteer)
+        return current._replace(users=users_df)
+
+    data = make_read_only(processor.process(raw, delta))
+    data.attrs['version'] = version
+    meta = read_snapshot_meta(SNAPSHOT_PATH)
+    if meta is None or meta['version'] != version or meta.get('processing') != PROCESSING_VERSION:
+        write_snapshot(data, version, SNAPSHOT_PATH, fields=raw.columns, processing=PROCESSING_VERSION,
+                       gazetteer=gazetteer)
+    return Dataset(data, list(raw.columns), users_df, version)
+
+@st.cache_resource
+def get_leads_sync():
+    return LeadsSync(backend, worksheet='leads')
+
+@st.cache_resource
+def get_users_sync():
+    return LeadsSync(backend, worksheet='users', key='Email')
+
+@st.cache_resource
+def get_refresher():
+    leads_sync = get_leads_sync()
+    users_sync = get_users_sync()
+    processor = LeadsProcessor()
+    refresher = DatasetRefresher(lambda current: refresh_leads(leads_sync, users_sync, processor, current),
+                                 interval=60)
+
+    # Cold start: serve the last snapshot right away, the refresher brings it up to date.
+    # A snapshot in an older processing layout, or geocoded with another gazetteer table than the current
+    # one, is ignored and rebuilt by the first refresh.
+    data, meta = read_snapshot(SNAPSHOT_PATH)
+    initial = None
+    if (data is not None and meta.get('processing') == PROCESSING_VERSION
+            and meta.get('gazetteer') == load_gazetteer().stamp):
+        data.attrs['version'] = meta['version']
+        users_sync.sync()
+        initial = Dataset(make_read_only(data), meta['fields'], users_sync.frame, meta['version'])
+
+    # A new dataset version only invalidates the caches derived from the leads data
+    refresher.subscribe(clear_dataset_caches)
+    # and patches the search index with the leads whose texts changed
+    search_index = shared_state(SearchIndex)
+    refresher.subscribe(lambda previous, dataset: search_index.sync(dataset.data))
+    # and the spatial index with the leads that were added, moved or dropped
+    spatial_index = shared_state(SpatialIndex)
+    refresher.subscribe(lambda previous, dataset: spatial_index.sync(dataset.data))
+    return refresher.start(initial=initial)
+
+# Fetch data (never waits on the sheet once a dataset is available)
+refresher = get_refresher()
+
+# A save/drop in this session asks for a synchronous refresh so the change shows up right away
+if st.session_state.pop('refresh_requested', False):
+    refresher.refresh()
+
+dataset = refresher.get()
+data, users_df = dataset.data, dataset.users
+# The feature ages and the lead cube are built once per dataset version, the charts take the rows of their
+# selection from them
+shared_state(FeatureAges).sync(data)
+shared_state(LeadCubes).sync(data)
 
 # Store in session-state
 st.session_state['data'] = data
-st.session_state['fields'] = list(data.columns)
-
-# preprocess-data
-data = process_data(data)
+st.session_state['fields'] = dataset.fields
 
 # ------------------------------- Authentication --------------------------------
-# st.cache_data.clear()
 
 authenticator, authentication_status, name, username = authenticate_user(users_df)
 handle_authentication_status(authenticator, authentication_status, name)
@@ -56,6 +145,16 @@ role=None
 # authentication_status = True
 if authentication_status:
     st.markdown(inner_styles, unsafe_allow_html=True)
+
+    refresh_stats = refresher.stats()
+    if refresh_stats['age'] is not None:
+        st.sidebar.caption(f"Data refreshed {refresh_stats['age']:.0f}s ago "
+                           f"(took {refresh_stats['last_duration']:.1f}s)")
+    if refresh_stats['last_error'] is not None:
+        st.sidebar.warning(f"Showing cached data, last refresh failed: {refresh_stats['last_error']}")
+    cache_stats = selection_cache.stats()
+    st.sidebar.caption(f"Filter cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                       f"{cache_stats['entries']} entries ({cache_stats['nbytes'] / 2 ** 20:.1f} MiB)")
     # menu_options = ['Overview', 'Marketing Attribution', 'Property Breakdown',
     #                 'Geographic Analytics', 'Leads Features', 'Update Leads']
     role = users_df[users_df['Email'] == username]['Role'].values[0] if authentication_status else None
@@ -95,5 +194,5 @@ if authentication_status:
         features_view(data)
 
     if menu == "Update Leads":
-        updatedata_view(data, conn)
+        updatedata_view(data, get_leads_sync())
 
@@ -0,0 +1,111 @@
+"""
+Throughput of `process_data` on synthetic leads sheets.
+
+    python benchmark_processing.py [rows ...]
+
+Without arguments the pipeline is timed at 10k, 100k and 1M rows. The frames
+mimic the raw sheet: text columns with gaps, floats with NaN and a few
+implausible construction years. The memory of the raw sheet (object columns)
+and of the processed frame is reported in bytes per row.
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_processing import (CATEGORICAL_COLS_KEINE, CATEGORICAL_COLS_NEIN, INFORMATION_FLAGS, NUMERICAL_COLS,
+                             process_data)
+
+SIZES = [10_000, 100_000, 1_000_000]
+REPEATS = 3
+
+STATES = {'Berlin': ('Berlin', 10), 'Bayern': ('München', 80), 'Hamburg': ('Hamburg', 20),
+          'Hessen': ('Frankfurt am Main', 60), 'Sachsen': ('Dresden', 1), 'Nordrhein-Westfalen': ('Köln', 50),
+          'Baden-Württemberg': ('Stuttgart', 70), 'Niedersachsen': ('Hannover', 30)}
+YEARS = ['0-5 Jahre', '5-10 Jahre', '10-15 Jahre', 'mehr als 15 Jahre']
+TEXTS = ['Schöne Lage am Stadtrand mit Garten', 'Dachsanierung notwendig', 'Wohnrecht im Grundbuch',
+         'Heizungsanlage erneuert 2019', 'Straßenlärm, aber gute Anbindung']
+
+
+def synthetic_leads(n, seed=0):
+    """
+    Raw leads frame with `n` rows, in the layout of the leads worksheet.
+    """
+    rng = np.random.default_rng(seed)
+
+    def pick(options, missing=0.1):
+        values = np.asarray(options, dtype=object)[rng.integers(0, len(options), n)]
+        values[rng.random(n) < missing] = np.nan
+        return values
+
+    def number(low, high, missing=0.1):
+        return np.where(rng.random(n) < missing, np.nan, rng.integers(low, high, n))
+
+    state = rng.integers(0, len(STATES), n)
+    names = list(STATES)
+    created = np.datetime64('2023-01-01') + rng.integers(0, 700 * 86400, n).astype('timedelta64[s]')
+    baujahr = number(1900, 2024, 0.05)
+    baujahr[rng.random(n) < 0.01] = 99
+
+    data = pd.DataFrame({
+        'Id': np.arange(1, n + 1),
+        'Created_at': np.datetime_as_string(created).astype(object),
+        'Vorname': pick(['Anna', 'Jürgen', 'Max', 'Lena', 'Sören', 'Eva'], 0),
+        'Nachname': pick(['Müller', 'Schmidt', 'Weiß', 'Groß', 'Becker'], 0),
+        'Email': pd.Series(rng.integers(0, n, n)).map('user{}@example.de'.format).to_numpy(dtype=object),
+        'Telefon': rng.integers(1510000000, 1519999999, n),
+        'bundesland': np.asarray(names, dtype=object)[state],
+        'Ort': np.asarray([STATES[name][0] for name in names], dtype=object)[state],
+        'Postleitzahl': np.asarray([STATES[name][1] for name in names])[state] * 1000 + rng.integers(0, 999, n),
+        'Strasse': pick(['Hauptstraße', 'Bahnhofstraße', 'Gartenweg'], 0),
+        'Hausnummer': rng.integers(1, 200, n),
+        'Objektzustand': pick(['gut', 'neuwertig', 'mittel', 'renovierungsbeduerftig', 'schlecht']),
+        'Ausstattung': pick(['luxus', 'gehoben', 'mittel', 'einfach', 'nicht zeitgemaess']),
+        'Objekttyp': pick(['Haus', 'Wohnung', 'Grundstück', 'Mehrfamilienhaus']),
+        'Haustyp': pick(['Einfamilienhaus', 'Doppelhaushälfte', 'Reihenhaus']),
+        'Aktuelle Nutzung': pick(['Eigennutzung', 'Vermietet', 'Leerstand']),
+        'Grundstueckflaeche': number(100, 5000),
+        'Wohnflaeche': number(40, 400, 0),
+        'Baujahr': baujahr,
+        'Parkplatz': pick(['Garage', 'Stellplatz', 'Tiefgarage']),
+        'Quelle': pick(['Google', 'Facebook', 'Empfehlung'], 0),
+        'Mieteinnahmen (Kaltmiete)': number(300, 3000, 0.5),
+    })
+    for col in NUMERICAL_COLS:
+        data[col] = number(0, 6, 0.3)
+    for col in CATEGORICAL_COLS_NEIN:
+        data[col] = pick(['Ja', 'Nein'], 0.3)
+    for col in CATEGORICAL_COLS_KEINE:
+        data[col] = pick(YEARS, 0.3)
+    for col in INFORMATION_FLAGS.values():
+        data[col] = pick(TEXTS, 0.5)
+    return data
+
+
+def bytes_per_row(data):
+    return data.memory_usage(deep=True).sum() / max(len(data), 1)
+
+
+def benchmark(n, repeats=REPEATS):
+    """
+    Best wall time of `repeats` runs of `process_data` on `n` synthetic rows,
+    with the raw and the processed frame.
+    """
+    raw = synthetic_leads(n)
+    best = float('inf')
+    for _ in range(repeats):
+        data = raw.copy()
+        start = time.perf_counter()
+        processed = process_data(data)
+        best = min(best, time.perf_counter() - start)
+    return best, raw, processed
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f"{'rows':>10} {'seconds':>9} {'rows/s':>12} {'raw B/row':>10} {'processed B/row':>16}")
+    for n in sizes:
+        seconds, raw, processed = benchmark(n)
+        print(f"{n:>10,} {seconds:>9.3f} {n / seconds:>12,.0f} {bytes_per_row(raw):>10,.0f} "
+              f"{bytes_per_row(processed):>16,.0f}")
@@ -1,125 +1,367 @@
+import numpy as np
 import pandas as pd
 
+from gazetteer import load_gazetteer
 
-def fill_na_columns(data, columns, fill_value):
+# Bump when process_data changes its output columns, so snapshots in the old layout are rebuilt
+PROCESSING_VERSION = 5
+
+NOT_SPECIFIED = 'Not Specified'
+
+LOCATION_COLS = ['bundesland', 'Ort', 'Postleitzahl', 'Objektzustand', 'Ausstattung', 'Objekttyp', 'Haustyp',
+                 'Aktuelle Nutzung']
+NUMERICAL_COLS = ['Wohneinheiten', 'Gewerbeeinheiten', 'Geschaeftsflaeche', 'Anhaenge/Dateien', 'Zimmeranzahl',
+                  'Etagenanzahl']
+CATEGORICAL_COLS_NEIN = ["Bebaut", "Alleinlage", "Erschlossen", 'Gastwc', 'Vollvermietet', 'Balkon', 'Aufzug',
+                         'Dachgeschoss', 'Keller', "100-Tage-Verkaufsgarantie", "Verkaufspreis", "Wertanalyse",
+                         "Verrentung"]
+CATEGORICAL_COLS_KEINE = ['Dach', 'Fenster', 'Leitungen', 'Heizung', 'Fassade', 'Badezimmer', 'Innenausbau',
+                          'Grundrissgestaltung']
+INFORMATION_FLAGS = {'has_immobilie_und_lage': 'Immobilie und Lage',
+                     'has_objektinformationen': 'Objektinformationen',
+                     'has_modernisierungen': 'Modernisierungen',
+                     'has_schaeden': 'Schaeden/Maengel',
+                     'has_besondere_rechte': 'Informationen zu besonderen Rechten',
+                     'has_nachricht': 'Nachricht'}
+
+# Value that replaces the missing entries of each column
+FILL_VALUES = {
+    **dict.fromkeys(LOCATION_COLS, NOT_SPECIFIED),
+    **dict.fromkeys(NUMERICAL_COLS, 0),
+    **dict.fromkeys(CATEGORICAL_COLS_NEIN, 'Nein'),
+    'Parkplatz': 'nein',
+    **dict.fromkeys(CATEGORICAL_COLS_KEINE, 'keine'),
+    **dict.fromkeys(INFORMATION_FLAGS.values(), 'No Information'),
+    'Mieteinnahmen (Kaltmiete)': 0,
+}
+# Columns whose missing entries are replaced with the column mean
+MEAN_FILL_COLS = ['Grundstueckflaeche']
+# Final dtype of the columns that are coerced after filling
+DTYPES = {'Id': 'int64', 'Baujahr': 'int16'}
+# Count columns, stored in the smallest integer type that holds them exactly
+COUNT_COLS = ['Wohneinheiten', 'Gewerbeeinheiten', 'Anhaenge/Dateien', 'Zimmeranzahl', 'Etagenanzahl']
+
+FEATURE_AGES = ['0-5 Jahre', '5-10 Jahre', '10-15 Jahre', 'mehr als 15 Jahre']
+# Low-cardinality text columns stored as categoricals. The listed categories come
+# first in this order, any other value that occurs is appended in sorted order.
+CATEGORIES = {
+    **dict.fromkeys(CATEGORICAL_COLS_NEIN, ['Ja', 'Nein']),
+    **dict.fromkeys(CATEGORICAL_COLS_KEINE, FEATURE_AGES + ['keine']),
+    'Objektzustand': ['gut', 'neuwertig', 'mittel', 'renovierungsbeduerftig', 'schlecht', NOT_SPECIFIED],
+    'Ausstattung': ['luxus', 'gehoben', 'mittel', 'einfach', 'nicht zeitgemaess', NOT_SPECIFIED],
+    **dict.fromkeys(['bundesland', 'Ort', 'Postleitzahl_2', 'Objekttyp', 'Haustyp', 'Aktuelle Nutzung',
+                     'Parkplatz', 'Quelle'], []),
+}
+
+BAUJAHR_RANGE = (1000, 9999)
+LIVING_AREA_BINS = [0, 800, 1100, 1300, 1500, 2000, 3000, 12900]
+LIVING_AREA_LABELS = [
+    'Up to 800 sqm',
+    '800-1100 sqm',
+    '1100-1300 sqm',
+    '1300-1500 sqm',
+    '1500-2000 sqm',
+    '2000-3000 sqm',
+    'Above 3000 sqm'
+]
+
+
+def fill_missing(values, fill_value):
     """
-    Function to handle missing values for specific columns.
+    Fills the missing entries of a column array in place. Float columns that
+    are filled with text become object columns.
     """
-    for col in columns:
-        data[col] = data[col].fillna(fill_value)
-    return data
+    missing = pd.isna(values)
+    if not missing.any():
+        return values
+    if isinstance(fill_value, str) and values.dtype != object:
+        values = values.astype(object)
+    values[missing] = fill_value
+    return values
 
 
-def fill_grundstueckflaeche_with_mean(data):
+def to_categorical(values, categories=(), fill_value=None):
     """
-    Function to fill missing values in 'Grundstueckflaeche' with its mean.
+    Categorical of a column array with `categories` first and the other values
+    that occur after them in sorted order, so no value is lost. Missing entries
+    become `fill_value` if one is given, without a separate pass over the column.
     """
-    if data['Grundstueckflaeche'].isnull().any():
-        mean_area = data['Grundstueckflaeche'].mean()
-        data['Grundstueckflaeche'] = data['Grundstueckflaeche'].fillna(mean_area)
-    return data
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques, dtype=object)
+    missing = codes < 0
+    if fill_value is not None and missing.any():
+        if fill_value not in uniques:
+            uniques = uniques.append(pd.Index([fill_value], dtype=object))
+        codes[missing] = uniques.get_loc(fill_value)
+    dtype = category_dtype(uniques, categories)
+    codes = np.where(codes >= 0, dtype.categories.get_indexer(uniques)[codes], -1)
+    return pd.Categorical.from_codes(codes, dtype=dtype)
 
 
-def process_baujahr(data):
+def category_dtype(values, categories=()):
     """
-    Function to process the 'Baujahr' column.
+    CategoricalDtype with `categories` first and the other distinct `values`
+    after them in sorted order.
     """
-    data['Baujahr'] = pd.to_numeric(data['Baujahr'], errors='coerce')
-    data['Baujahr'] = data['Baujahr'].dropna().astype(int).round()
-    data = data[(data['Baujahr'] >= 1000) & (data['Baujahr'] <= 9999)]
-    return data
+    categories = list(categories)
+    known = set(categories)
+    return pd.CategoricalDtype(categories + sorted({value for value in values if value not in known}, key=str))
 
 
-def categorize_property_area(data):
+def used_categories(values, dropped=()):
     """
-    Function to bin the living area and categorize it.
+    The categories of a categorical Series that occur in it, leaving out the
+    rows at the positions `dropped`.
     """
-    living_area_bins = [0, 800, 1100, 1300, 1500, 2000, 3000, 12900]
-    living_area_labels = [
-        'Up to 800 sqm',
-        '800-1100 sqm',
-        '1100-1300 sqm',
-        '1300-1500 sqm',
-        '1500-2000 sqm',
-        '2000-3000 sqm',
-        'Above 3000 sqm'
-    ]
-    data['property_area_range'] = pd.cut(data['Grundstueckflaeche'], bins=living_area_bins, labels=living_area_labels)
-    return data
+    codes = values.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))
+    dropped = codes[np.asarray(dropped, dtype=np.intp)]
+    counts -= np.bincount(dropped[dropped >= 0], minlength=len(counts))
+    return values.cat.categories[counts > 0]
 
 
-def process_postleitzahl(data):
+def plain_dtypes(data):
     """
-    Function to process 'Postleitzahl' column.
+    Returns a copy of `data` with the categorical columns as object columns, for
+    code that writes arbitrary values into the frame (e.g. the update form).
     """
-    data['Postleitzahl_2'] = data['Postleitzahl'].apply(lambda x: f"DE-{str(x)[-2:]}" if x != 'Not Specified' else x)
-    return data
+    categorical = [col for col, dtype in data.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    return data.astype(dict.fromkeys(categorical, object))
 
 
-def process_created_at(data):
+def postcode_text(postleitzahl):
     """
-    Function to fill 'Created_at' column with proper datetime values.
+    The postcodes as text, whether the sheet cells were read as text, integers
+    or floats (50250, 50250.0 and '50250' -> '50250'), so the column has one
+    type and reads back from the snapshot unchanged. Each distinct value is
+    converted once.
     """
-    data['Created_at'] = pd.to_datetime(data['Created_at'], errors='coerce')
-    return data
+    codes, uniques = pd.factorize(postleitzahl, use_na_sentinel=False)
+    texts = np.array([str(int(x)) if isinstance(x, (int, float, np.number)) and not isinstance(x, bool)
+                      and np.isfinite(x) and x == int(x) else str(x) for x in uniques], dtype=object)
+    return texts[codes]
 
 
-def process_rental_income(df):
-    df['Mieteinnahmen (Kaltmiete)'] = df['Mieteinnahmen (Kaltmiete)'].fillna(0)
-    # df['Mieteinnahmen (Kaltmiete)'] = df['Mieteinnahmen (Kaltmiete)'].str.replace(r'[€,\smonatlich, â‚ ¬]', '', regex=True)
-    # df['Mieteinnahmen (Kaltmiete)'] = df['Mieteinnahmen (Kaltmiete)'].str.replace(',', '.')
-    # df['Mieteinnahmen (Kaltmiete)'] = pd.to_numeric(df['Mieteinnahmen (Kaltmiete)'], errors='coerce')
-    return df
+def postleitzahl_region(postleitzahl):
+    """
+    Maps postcodes to their 'DE-<last two digits>' region label, leaving
+    'Not Specified' as it is. The label is built once per distinct postcode.
+    """
+    codes, uniques = pd.factorize(postleitzahl, use_na_sentinel=False)
+    labels = np.array([f"DE-{str(x)[-2:]}" if x != NOT_SPECIFIED else x for x in uniques], dtype=object)
+    return labels[codes]
 
 
-def process_data(data):
+def presence_flags(columns):
     """
-    Main process_data function that integrates all the smaller functions.
+    Flags which free-text fields are filled in and whether files are attached,
+    so the filters compare booleans instead of strings.
     """
+    flags = {flag: columns[col] != 'No Information' for flag, col in INFORMATION_FLAGS.items()}
+    flags['has_anhaenge'] = pd.to_numeric(columns['Anhaenge/Dateien'], errors='coerce') > 0
+    return flags
 
-    data['Id'] = data['Id'].astype('int64')
 
-    # Fill missing values for 'bundesland', 'Ort', and 'Postleitzahl', 'Objektzustand', 'Ausstattung'
-    data = fill_na_columns(data, ['bundesland', 'Ort', 'Postleitzahl', 'Objektzustand', 'Ausstattung', 'Objekttyp', 'Haustyp', 'Aktuelle Nutzung'], 'Not Specified')
+def process_data(data, previous=None, removed_ids=(), means=None, order=None):
+    """
+    Cleans the raw leads sheet following the column spec above. Rows without a
+    plausible 'Baujahr' are dropped, and every column is taken, filled and
+    coerced once before the processed frame is built in a single step.
 
-    # Fill missing 'Grundstueckflaeche' with mean value
-    data = fill_grundstueckflaeche_with_mean(data)
+    The result uses a compact layout: categoricals for the low-cardinality text
+    columns, boolean flags and downcast integers for years and counts. The
+    coordinates of every lead ('lat', 'lon') are resolved here from the offline
+    postcode gazetteer, so they are stored in the snapshot with the other columns.
 
-    # Process 'Baujahr' column
-    data = process_baujahr(data)
+    Incremental mode: given the `previous` processed frame, `data` only holds the
+    new or changed raw leads. They are processed and merged into `previous` by
+    Id (see merge_processed), and the leads in `removed_ids` are dropped.
 
-    # Categorize property area
-    data = categorize_property_area(data)
+    Args:
+        means (dict): column -> RunningMean over all raw leads, used instead of
+            the means of `data` to fill missing values.
+        order: the Ids of the raw sheet in sheet order, to give an incremental
+            result the row order and index of a full run.
+    """
+    baujahr = np.trunc(pd.to_numeric(data['Baujahr'], errors='coerce')).to_numpy()
+    keep = (baujahr >= BAUJAHR_RANGE[0]) & (baujahr <= BAUJAHR_RANGE[1])
+    # The means are taken over all raw leads, before rows are dropped
+    if means is None:
+        fill_values = {**FILL_VALUES, **{col: data[col].mean() for col in MEAN_FILL_COLS}}
+    else:
+        fill_values = {**FILL_VALUES, **{col: running.mean for col, running in means.items()}}
 
-    # Process 'Postleitzahl' column
-    data = process_postleitzahl(data)
+    columns = {}
+    for col in data.columns:
+        values = baujahr[keep] if col == 'Baujahr' else data[col].to_numpy()[keep]
+        if col in CATEGORIES:
+            values = to_categorical(values, CATEGORIES[col], fill_values.get(col))
+        elif col in fill_values:
+            values = fill_missing(values, fill_values[col])
+        if col in DTYPES:
+            values = values.astype(DTYPES[col])
+        elif col in COUNT_COLS and values.dtype.kind == 'f':
+            values = pd.to_numeric(values, downcast='integer')
+        columns[col] = values
+    columns['Created_at'] = pd.to_datetime(columns['Created_at'], errors='coerce')
+    columns['Postleitzahl'] = postcode_text(columns['Postleitzahl'])
+    columns['property_area_range'] = area_range(columns['Grundstueckflaeche'])
+    columns['Postleitzahl_2'] = to_categorical(postleitzahl_region(columns['Postleitzahl']),
+                                               CATEGORIES['Postleitzahl_2'])
+    # Coordinates of the postcode (or place) from the offline gazetteer, NaN where unknown
+    columns['lat'], columns['lon'] = load_gazetteer().locate(columns['Postleitzahl'], columns['Ort'])
+    columns.update(presence_flags(columns))
+    processed = pd.DataFrame(columns, index=data.index[keep])
+    if previous is None:
+        return processed
+    return merge_processed(previous, processed, data['Id'], removed_ids, means, order)
 
-    # Process 'Created_at' column
-    data = process_created_at(data)
 
-    # Fill numerical columns with 0
-    numerical_cols = ['Wohneinheiten', 'Gewerbeeinheiten', 'Geschaeftsflaeche',
-                      'Anhaenge/Dateien', 'Zimmeranzahl', 'Etagenanzahl']
-    data = fill_na_columns(data, numerical_cols, 0)
+def area_range(area):
+    """
+    Bins the lot area into the ranges of the living area filter.
+    """
+    return pd.cut(area, bins=LIVING_AREA_BINS, labels=LIVING_AREA_LABELS)
 
-    # Fill categorical columns with 'Nein'
-    categorical_cols_nein = ["Bebaut", "Alleinlage", "Erschlossen", 'Gastwc', 'Vollvermietet',
-                             'Balkon', 'Aufzug', 'Dachgeschoss', 'Keller', "100-Tage-Verkaufsgarantie",
-                             "Verkaufspreis", "Wertanalyse", "Verrentung"]
-    data = fill_na_columns(data, categorical_cols_nein, 'Nein')
 
-    # Fill 'Parkplatz' column with 'nein'
-    data['Parkplatz'] = data['Parkplatz'].fillna('nein')
+def lead_ids(ids):
+    return pd.Index(np.asarray(ids).astype('int64'))
 
-    # Fill other specific columns with 'keine' or 'No Information'
-    categorical_cols_keine = ['Dach', 'Fenster', 'Leitungen', 'Heizung', 'Fassade',
-                              'Badezimmer', 'Innenausbau', 'Grundrissgestaltung']
-    data = fill_na_columns(data, categorical_cols_keine, 'keine')
 
-    information_cols = ['Immobilie und Lage', 'Objektinformationen', 'Modernisierungen',
-                        'Schaeden/Maengel', 'Informationen zu besonderen Rechten', 'Nachricht']
-    data = fill_na_columns(data, information_cols, 'No Information')
+def merge_processed(previous, processed, changed_ids, removed_ids=(), means=None, order=None):
+    """
+    Replaces the leads `changed_ids` of the processed frame `previous` with the
+    freshly `processed` ones (a changed lead that no longer passes the Baujahr
+    check is dropped) and removes `removed_ids`. The categories are merged the
+    way process_data builds them. With `means` (column -> RunningMean) the leads
+    whose raw value is missing are refilled with the current mean, and `order`
+    (raw Ids in sheet order) restores the sheet order and index, so the result
+    matches a full run.
+    """
+    stale = lead_ids(changed_ids).append(lead_ids(list(removed_ids)))
+    dropped = np.flatnonzero(previous['Id'].isin(stale).to_numpy())
 
-    data = process_rental_income(data)
+    dtypes = {}
+    for col in CATEGORIES:
+        if col in previous.columns:
+            used = used_categories(previous[col], dropped).append(used_categories(processed[col]))
+            dtypes[col] = category_dtype(used, CATEGORIES[col])
+    combined = pd.concat([previous.astype(dtypes, copy=False), processed.astype(dtypes, copy=False)],
+                         ignore_index=True)
+    # Dropping the stale leads and restoring the sheet order is a single take
+    rows = np.delete(np.arange(len(combined)), dropped)
+    if order is not None:
+        positions = lead_ids(order).get_indexer(combined['Id'].to_numpy()[rows])
+        sort = np.argsort(positions, kind='stable')
+        rows, positions = rows[sort], positions[sort]
+    merged = combined.take(rows)
+    merged.index = positions if order is not None else pd.RangeIndex(len(rows))
 
+    for col in COUNT_COLS:
+        if merged[col].dtype.kind in 'fi':
+            merged[col] = pd.to_numeric(merged[col], downcast='integer')
+    if means:
+        for col, running in means.items():
+            merged.loc[merged['Id'].isin(running.missing_ids()).to_numpy(), col] = running.mean
+        merged['property_area_range'] = area_range(merged['Grundstueckflaeche'])
+    return merged
+
+
+class RunningMean:
+    """
+    Mean of a raw column over all leads, kept up to date from sync deltas
+    instead of being recomputed over the sheet. The raw value of every lead is
+    kept by Id, so a changed or removed lead can be taken out of the running
+    sum again.
+    """
+
+    def __init__(self, ids=(), values=()):
+        values = pd.to_numeric(np.asarray(values), errors='coerce')
+        self.values = pd.Series(values, index=lead_ids(ids), dtype=float)
+        self.total = self.values.sum()
+        self.count = int(self.values.count())
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    def missing_ids(self):
+        return self.values.index[self.values.isna().to_numpy()]
+
+    def update(self, ids, values, removed_ids=()):
+        """
+        Returns a new RunningMean with the leads `ids` set to `values` (new or
+        changed leads) and `removed_ids` taken out.
+        """
+        fresh = RunningMean(ids, values)
+        stale = self.values[self.values.index.isin(fresh.values.index.append(lead_ids(list(removed_ids))))]
+        result = RunningMean()
+        result.values = pd.concat([self.values.drop(stale.index), fresh.values])
+        result.total = self.total - stale.sum() + fresh.total
+        result.count = self.count - int(stale.count()) + fresh.count
+        return result
+
+
+class LeadsProcessor:
+    """
+    Keeps the processed leads frame in step with the raw sheet of LeadsSync.
+
+    A SyncDelta that directly follows the last one seen (`delta.base` equals
+    the processed generation) is applied incrementally: only its rows are
+    processed and merged by Id, and the means used to fill missing values are
+    updated as running aggregates. Anything else (first run, a delta that was
+    missed, changed columns, duplicate Ids, another gazetteer table) processes
+    the whole sheet.
+    """
+
+    def __init__(self):
+        self.data = None
+        self.fields = None
+        self.means = {}
+        self.generation = None
+        self.gazetteer = None
+
+    def process(self, raw, delta=None):
+        """
+        Returns the processed frame of `raw`, the sheet after `delta` was applied.
+        """
+        gazetteer = load_gazetteer().stamp
+        incremental = (self.data is not None and delta is not None and delta.base == self.generation
+                       and list(raw.columns) == self.fields and raw['Id'].is_unique
+                       and delta.changed['Id'].is_unique and gazetteer == self.gazetteer)
+        if incremental:
+            changed, removed_ids = delta.changed, delta.removed_ids
+            means = {col: running.update(changed['Id'], changed[col], removed_ids)
+                     for col, running in self.means.items()}
+            data = process_data(changed, previous=self.data, removed_ids=removed_ids, means=means,
+                                order=raw['Id'])
+        else:
+            means = {col: RunningMean(raw['Id'], raw[col]) for col in MEAN_FILL_COLS}
+            data = process_data(raw, means=means)
+        self.data, self.fields, self.means = data, list(raw.columns), means
+        self.generation = delta.generation if delta is not None else None
+        self.gazetteer = gazetteer
+        return data
+
+    def adopt(self, data, raw, delta=None, gazetteer=None):
+        """
+        Takes `data`, a processed frame of `raw` that is already available (e.g.
+        the snapshot) and geocoded with the gazetteer stamped `gazetteer`, as
+        the base for the next delta without processing again.
+        """
+        if data is not self.data:
+            self.data, self.fields, self.gazetteer = data, list(raw.columns), gazetteer
+            self.means = {col: RunningMean(raw['Id'], raw[col]) for col in MEAN_FILL_COLS}
+        self.generation = delta.generation if delta is not None else None
+
+
+def make_read_only(data):
+    """
+    Marks the arrays behind a processed frame as read-only. The frame is shared
+    by all sessions, so an accidental in-place write should fail loudly instead
+    of changing the data for everybody. Filtering or copying gives a writable frame.
+    """
+    for block in data._mgr.blocks:
+        if isinstance(block.values, np.ndarray):
+            block.values.flags.writeable = False
     return data
@@ -0,0 +1,165 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from sheets import merge_rows, normalize_ids
+
+# `base` and `generation` number the deltas: a delta applies on top of the state
+# after the delta whose generation equals its base
+SyncDelta = namedtuple('SyncDelta', ['changed', 'removed_ids', 'base', 'generation'], defaults=(None, None))
+
+
+def _row_hashes(df, key):
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    hashes.index = df[key].to_numpy()
+    return hashes[~hashes.index.duplicated(keep='last')]
+
+
+class LeadsSync:
+    """
+    Keeps a local copy of a worksheet and only pulls the rows whose Id is new
+    or whose content changed since the last sync. Writes made through `upsert`
+    and `delete` only touch the affected rows of the sheet and are applied to
+    the local copy directly.
+
+    The watermark is the backend's modification stamp: while it is unchanged a
+    sync costs a single metadata call. When the sheet changed, just the new tail
+    is read if the backend can prove that rows were only appended since the last
+    read (`read_appended`, the content stamp of the local CSV files). Anything
+    else (edits in place, deletes, reordering, a backend without that proof)
+    and every `reconcile_every`-th change falls back to a full read that is
+    diffed against per-row content hashes, so only rows that really changed are
+    reported. Rows written through `upsert` and `delete` are reported by the
+    next sync as well, so every change of the local copy shows up in exactly
+    one delta. The watermark is not advanced over our own writes: an outside
+    edit landing next to a write would pass for synced, so the sync after a
+    write always reconciles.
+    """
+
+    def __init__(self, backend, worksheet='leads', key='Id', reconcile_every=10):
+        self.backend = backend
+        self.worksheet = worksheet
+        self.key = key
+        self.reconcile_every = reconcile_every
+        self.frame = None
+        self.watermark = None
+        self._stamp = None
+        self._hashes = None
+        self._changes_since_reconcile = 0
+        self._reconcile_pending = False
+        self._written_ids = set()
+        self._deleted_ids = set()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """
+        Brings the local copy up to date.
+
+        Returns:
+            SyncDelta: the new or changed rows and the Ids that disappeared since
+            the previous sync.
+        """
+        with self._lock:
+            watermark = self.backend.modified_at(self.worksheet)
+            if self.frame is None or self._reconcile_pending:
+                return self._delta(*self._reconcile(watermark))
+            if watermark == self.watermark:
+                return self._delta(self.frame.iloc[0:0], [])
+
+            self._changes_since_reconcile += 1
+            if self._changes_since_reconcile >= self.reconcile_every:
+                return self._delta(*self._reconcile(watermark))
+
+            appended = None
+            if self._stamp is not None:
+                appended = self.backend.read_appended(self.worksheet, self._stamp)
+            if appended is None:
+                return self._delta(*self._reconcile(watermark))
+
+            tail, self._stamp = appended
+            self.frame = pd.concat([self.frame, tail], ignore_index=True)
+            self.frame = self.frame.drop_duplicates(subset=self.key, keep='last').reset_index(drop=True)
+            self._hashes = _row_hashes(self.frame, self.key)
+            self.watermark = watermark
+            return self._delta(tail, [])
+
+    def _delta(self, changed, removed_ids):
+        """
+        Adds the rows written through upsert/delete since the previous sync to a
+        delta and numbers it.
+        """
+        if self._written_ids:
+            written = self.frame[np.isin(normalize_ids(self.frame[self.key]), list(self._written_ids))]
+            changed = pd.concat([changed, written])
+            changed = changed[~pd.Index(normalize_ids(changed[self.key])).duplicated(keep='last')]
+        removed_ids = list(set(removed_ids) | self._deleted_ids)
+        self._written_ids, self._deleted_ids = set(), set()
+        self._generation += 1
+        return SyncDelta(changed, removed_ids, self._generation - 1, self._generation)
+
+    def _reconcile(self, watermark):
+        # Stamped before the read: a change in between fails the append check of the next sync
+        content_stamp = getattr(self.backend, 'content_stamp', None)
+        self._stamp = content_stamp(self.worksheet) if content_stamp is not None else None
+        fresh = self.backend.read(self.worksheet).reset_index(drop=True)
+        hashes = _row_hashes(fresh, self.key)
+
+        if self._hashes is None:
+            changed = fresh
+            removed_ids = []
+        else:
+            common = hashes.index.intersection(self._hashes.index)
+            edited = common[self._hashes[common].to_numpy() != hashes[common].to_numpy()]
+            changed_ids = hashes.index.difference(self._hashes.index).union(edited)
+            changed = fresh[fresh[self.key].isin(changed_ids)]
+            removed_ids = list(self._hashes.index.difference(hashes.index))
+
+        self.frame = fresh
+        self._hashes = hashes
+        self.watermark = watermark
+        self._changes_since_reconcile = 0
+        self._reconcile_pending = False
+        return changed, removed_ids
+
+    def upsert(self, rows):
+        """
+        Writes new or changed rows to the sheet by Id and merges them into the
+        local copy, without re-reading the sheet. The next sync reconciles
+        against the row hashes of the last read, also when the write failed
+        part way, e.g. after the updates but before the append.
+        """
+        with self._lock:
+            try:
+                self.backend.upsert_rows(self.worksheet, rows, key=self.key)
+            finally:
+                self._reconcile_pending = True
+            if self.frame is None:
+                return
+            self.frame = merge_rows(self.frame, rows, key=self.key)
+            self._written_ids.update(normalize_ids(rows[self.key]).tolist())
+
+    def delete(self, ids):
+        """
+        Deletes the rows with the given Ids from the sheet and from the local copy.
+        The next sync reconciles against the row hashes of the last read, also
+        when the delete failed, as a failed request may still have been applied.
+
+        Returns:
+            int: the number of deleted rows.
+        """
+        with self._lock:
+            try:
+                deleted = self.backend.delete_rows(self.worksheet, ids, key=self.key)
+            except Exception:
+                self._reconcile_pending = True
+                raise
+            if self.frame is None or not deleted:
+                return deleted
+            keep = ~np.isin(normalize_ids(self.frame[self.key]), normalize_ids(ids))
+            self._deleted_ids.update(self.frame.loc[~keep, self.key].tolist())
+            self.frame = self.frame[keep].reset_index(drop=True)
+            self._reconcile_pending = True
+            return deleted
@@ -0,0 +1,123 @@
+import functools
+import threading
+
+import pandas as pd
+import streamlit as st
+
+from snapshot import frame_version
+
+_dataset_caches = []
+
+
+def frame_cache_key(df):
+    """
+    Cache key for a leads DataFrame argument.
+
+    Frames coming out of the filters carry the dataset version and a canonical
+    signature of the filter selection in `df.attrs`, which identifies their
+    content without looking at the rows. Any other frame falls back to a
+    content hash.
+    """
+    version = df.attrs.get('version')
+    if version is None or 'selection' not in df.attrs:
+        return frame_version(df)
+    return version, df.attrs['selection'], len(df), tuple(df.columns)
+
+
+def dataset_cache(func=None, *, max_entries=32, **kwargs):
+    """
+    Drop-in for `st.cache_data` on functions derived from the leads dataset.
+
+    The decorated functions are registered, so a new dataset version clears
+    exactly these caches (see `clear_dataset_caches`) while caches that do not
+    depend on the leads data, such as the GeoJSON boundaries, stay warm.
+    DataFrame arguments are keyed with `frame_cache_key` instead of being
+    hashed row by row on every call.
+    """
+    hash_funcs = {pd.DataFrame: frame_cache_key, **kwargs.pop('hash_funcs', {})}
+
+    def decorator(f):
+        cached = st.cache_data(f, max_entries=max_entries, hash_funcs=hash_funcs, **kwargs)
+        _dataset_caches.append(cached)
+        return cached
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def per_version(build=None, *, max_entries=2):
+    """
+    Caches `build(data)`, a structure derived from the leads frame, so it is
+    built once per dataset version (`data.attrs['version']`) and shared by all
+    sessions. Slices inherit the version, so the row count is part of the key
+    as well. Frames without a version are built on every call.
+    """
+    def decorator(f):
+        def cached(_data, version, n_rows):
+            return f(_data)
+        # Streamlit keys a cache by the qualified name and source of the function,
+        # which are the same for every `cached`
+        cached.__module__, cached.__qualname__ = f.__module__, f"{f.__qualname__}.<per_version>"
+        cached = st.cache_resource(cached, max_entries=max_entries)
+
+        @functools.wraps(f)
+        def get(data):
+            version = data.attrs.get('version')
+            if version is None:
+                return f(data)
+            return cached(data, version, len(data))
+        return get
+
+    if build is not None:
+        return decorator(build)
+    return decorator
+
+
+class VersionedState:
+    """
+    Base of the structures derived from the full leads frame that are built
+    once per dataset version and shared by all sessions (see `shared_state`).
+    Subclasses build their state in `_build`, and read it with `current` so a
+    concurrent `sync` never hands out the version of one state with another.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.state = None
+        self._lock = threading.Lock()
+
+    def sync(self, data):
+        """
+        Builds the state of `data` (the full processed leads frame) unless its
+        version is already built.
+        """
+        version = data.attrs.get('version')
+        with self._lock:
+            if version is not None and version == self.version:
+                return
+            self.state = self._build(data)
+            self.version = version
+
+    def current(self):
+        """
+        The version and the state last built.
+        """
+        with self._lock:
+            return self.version, self.state
+
+
+@st.cache_resource
+def shared_state(state_class):
+    """
+    The instance of `state_class` shared by all sessions.
+    """
+    return state_class()
+
+
+def clear_dataset_caches(*_):
+    """
+    Drops the entries derived from older dataset versions.
+    """
+    for cached in _dataset_caches:
+        cached.clear()
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from data_processing import CATEGORICAL_COLS_KEINE
+from dataset_cache import VersionedState
+
+FEATURE_COLUMNS = CATEGORICAL_COLS_KEINE
+# Age in years of each Jahre bucket; 'keine' (no such feature) has no age
+FEATURE_AGE_YEARS = {'0-5 Jahre': 0, '5-10 Jahre': 5, '10-15 Jahre': 10, 'mehr als 15 Jahre': 15}
+
+
+def encode_feature_ages(data):
+    """
+    The feature ages of `data` as an (n, 8) float32 matrix in the order of
+    FEATURE_COLUMNS, NaN for 'keine'. Categorical columns are encoded through
+    their codes, so the text values are never looked at row by row.
+    """
+    matrix = np.empty((len(data), len(FEATURE_COLUMNS)), dtype=np.float32)
+    for j, col in enumerate(FEATURE_COLUMNS):
+        values = data[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # The trailing NaN is picked up by the code -1 of missing values
+            years = np.asarray(values.cat.categories.map(FEATURE_AGE_YEARS), dtype=np.float32)
+            matrix[:, j] = np.append(years, np.float32(np.nan))[values.cat.codes.to_numpy()]
+        else:
+            matrix[:, j] = values.map(FEATURE_AGE_YEARS).to_numpy(dtype=np.float32, na_value=np.nan)
+    return matrix
+
+
+def grouped_feature_means(matrix, groups):
+    """
+    Mean age per feature for every group of `groups` (a column of the frame
+    the rows of `matrix` belong to), skipping NaN like `groupby().mean()`.
+    The matrix is grouped as a single block on integer group codes, and the
+    groups come out in the order of `groupby(observed=True)`.
+
+    Returns:
+        DataFrame: one row per group, one column per feature.
+    """
+    if isinstance(groups.dtype, pd.CategoricalDtype):
+        codes, uniques = groups.cat.codes.to_numpy(), pd.CategoricalIndex(groups.cat.categories, dtype=groups.dtype)
+    else:
+        codes, uniques = pd.factorize(groups, sort=True)
+    means = pd.DataFrame(matrix, columns=FEATURE_COLUMNS, dtype=float).groupby(codes).mean()
+    # Rows without a group value have the code -1
+    means = means[means.index >= 0]
+    means.index = pd.Index(uniques[means.index.to_numpy()], name=groups.name)
+    return means
+
+
+def feature_age_bucket(age):
+    """
+    Maps an (average) age back to its Jahre bucket, 'keine' for NaN.
+    """
+    if 0 <= age < 5:
+        return "0-5 Jahre"
+    elif 5 <= age < 10:
+        return "5-10 Jahre"
+    if 10 <= age < 15:
+        return "10-15 Jahre"
+    elif age >= 15:
+        return "mehr als 15 Jahre"
+    else:
+        return "keine"
+
+
+class FeatureAges(VersionedState):
+    """
+    The feature-age matrix of the current leads frame, encoded once per
+    dataset version. Filtered frames share the version and keep the index
+    labels of the full frame, so their rows are taken from the matrix
+    instead of being encoded again.
+    """
+
+    def _build(self, data):
+        matrix = encode_feature_ages(data)
+        matrix.flags.writeable = False
+        return data.index if data.index.is_unique else None, matrix
+
+    def matrix_of(self, df):
+        """
+        The feature-age matrix of the rows of `df`.
+        """
+        version, state = self.current()
+        if version is not None and df.attrs.get('version') == version:
+            index, matrix = state
+            positions = index.get_indexer(df.index) if index is not None else None
+            if positions is not None and (positions >= 0).all():
+                return matrix[positions]
+        return encode_feature_ages(df)
@@ -0,0 +1,234 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import per_version
+
+LocationNode = namedtuple('LocationNode', ['rows', 'names', 'ids', 'emails'])
+
+FILTER_COLUMNS = ['bundesland', 'Ort', 'Postleitzahl_2', 'Objekttyp', '100-Tage-Verkaufsgarantie',
+                  'Baujahr', 'property_area_range']
+
+
+class FilterIndex:
+    """
+    Per-value row-id lists (postings) for the filter dimensions of the leads frame.
+
+    Every column is factorized once into integer codes. The row ids of each value
+    are stored in CSR form: `order[offsets[c]:offsets[c + 1]]` are the ascending
+    row positions with code `c`. A selection is answered by taking the union of the
+    postings of the most selective dimension and narrowing these candidates with a
+    code lookup per further dimension. Dimensions left at 'All' are skipped, so the
+    cost depends on the size of the result, not on the size of the dataset.
+    """
+
+    def __init__(self, data, columns=FILTER_COLUMNS):
+        self.n_rows = len(data)
+        self.codes = {}
+        self.values = {}
+        self.counts = {}
+        self.offsets = {}
+        self.order = {}
+        for col in columns:
+            codes, uniques = pd.factorize(data[col].to_numpy(dtype=object), use_na_sentinel=False)
+            counts = np.bincount(codes, minlength=len(uniques))
+            self.codes[col] = codes.astype(np.int32)
+            self.values[col] = pd.Index(uniques, dtype=object)
+            self.counts[col] = counts
+            self.offsets[col] = np.concatenate([[0], np.cumsum(counts)])
+            self.order[col] = np.argsort(codes, kind='stable').astype(np.int32)
+
+    def value_codes(self, col, values):
+        """
+        Codes of the given values of `col`; values that do not occur are ignored.
+        """
+        codes = self.values[col].get_indexer(pd.Index(list(values), dtype=object))
+        return np.unique(codes[codes >= 0])
+
+    def postings(self, col, codes):
+        """
+        Ascending row positions of the rows whose `col` has one of `codes`.
+        """
+        offsets, order = self.offsets[col], self.order[col]
+        if not len(codes):
+            return np.empty(0, dtype=np.int32)
+        if len(codes) == 1:
+            return order[offsets[codes[0]]:offsets[codes[0] + 1]]
+        if self.counts[col][codes].sum() > self.n_rows // 8:
+            # Merging large postings costs more than one pass over the codes
+            return np.flatnonzero(self._wanted(col, codes)[self.codes[col]])
+        return np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in codes]))
+
+    def _wanted(self, col, codes):
+        wanted = np.zeros(len(self.values[col]), dtype=bool)
+        wanted[codes] = True
+        return wanted
+
+    def select(self, selection):
+        """
+        Row positions (ascending) that match every dimension of `selection`, a dict
+        of column -> selected values. Empty value lists mean 'All'.
+        """
+        active = [(col, self.value_codes(col, values)) for col, values in selection.items() if len(values)]
+        if not active:
+            return np.arange(self.n_rows)
+
+        active.sort(key=lambda item: self.counts[item[0]][item[1]].sum())
+        col, codes = active[0]
+        # None of the values selected in that dimension occurs
+        if not len(codes):
+            return np.empty(0, dtype=np.int32)
+        rows = self.postings(col, codes)
+        for col, codes in active[1:]:
+            if not len(rows):
+                break
+            rows = rows[self._wanted(col, codes)[self.codes[col][rows]]]
+        return rows
+
+
+    def facet_counts(self, selection):
+        """
+        Matches `selection` and counts, for every dimension, the rows per value
+        under the selections of all *other* dimensions. That is what a dependent
+        option list shows: picking a Bundesland narrows the cities, but not the
+        other Bundeslaender.
+
+        Returns:
+            tuple: (matching row positions, dict of column -> counts indexed by code)
+        """
+        matched = self.select(selection)
+        counts = {}
+        for col in self.codes:
+            rows = matched
+            if len(selection.get(col, [])):
+                rows = self.select({c: v for c, v in selection.items() if c != col})
+            if len(rows) == self.n_rows:
+                counts[col] = self.counts[col]
+            else:
+                counts[col] = np.bincount(self.codes[col][rows], minlength=len(self.values[col]))
+        return matched, counts
+
+
+def _group_uniques(groups, values, n_groups, sort=False):
+    """
+    Distinct values per group, in order of appearance (or sorted), as a list of arrays.
+    """
+    pairs = pd.DataFrame({'group': groups, 'value': values}).drop_duplicates()
+    pairs = pairs.sort_values(['group', 'value'] if sort else 'group', kind='stable')
+    bounds = np.searchsorted(pairs['group'].to_numpy(), np.arange(1, n_groups))
+    return np.split(pairs['value'].to_numpy(), bounds)
+
+
+class LocationIndex:
+    """
+    City -> postcode -> leads hierarchy for the Leads Features view.
+
+    `cities[ort][postleitzahl_2]` is a LocationNode with the ascending row
+    positions of its leads and the vocabularies of its name, Id and email
+    pickers, so drilling down to a lead is a dictionary lookup. Cities and
+    postcodes keep the order in which they first appear in the data.
+    """
+
+    def __init__(self, data):
+        groups = data.groupby(['Ort', 'Postleitzahl_2'], sort=False, observed=True, dropna=False).ngroup().to_numpy()
+        n_groups = groups.max() + 1 if len(groups) else 0
+        order = np.argsort(groups, kind='stable')
+        rows = np.split(order, np.flatnonzero(np.diff(groups[order])) + 1) if len(order) else []
+        names = _group_uniques(groups, data['Vorname'].to_numpy(), n_groups)
+        ids = _group_uniques(groups, data['Id'].to_numpy(), n_groups, sort=True)
+        emails = _group_uniques(groups, data['Email'].to_numpy(), n_groups)
+
+        self.cities = {}
+        for group, group_rows in enumerate(rows):
+            city, postcode = data['Ort'].iat[group_rows[0]], data['Postleitzahl_2'].iat[group_rows[0]]
+            self.cities.setdefault(city, {})[postcode] = LocationNode(group_rows, names[group], ids[group],
+                                                                      emails[group])
+
+
+def _arrays(value):
+    if isinstance(value, np.ndarray):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _arrays(item)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _arrays(item)
+
+
+class SelectionCache:
+    """
+    Bounded LRU cache of filter results (matching row ids and option counts),
+    keyed by dataset version and canonical selection. It is shared by all
+    sessions, so a combination that any user filtered before is served without
+    touching the index. Entries are evicted least recently used first once
+    their arrays exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Returns the cached value for `key`, or computes, stores and returns it.
+        Cached arrays are read-only since they are shared.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        value = compute()
+        size = 0
+        for array in _arrays(value):
+            array.flags.writeable = False
+            size += array.nbytes
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = (value, size)
+                self.nbytes += size
+                while self.nbytes > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.nbytes -= evicted_size
+                    self.evictions += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'nbytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Shared by every session of the process
+selection_cache = SelectionCache()
+
+
+@per_version
+def get_filter_index(data):
+    """
+    Returns the FilterIndex of `data`, built once per dataset version.
+    """
+    return FilterIndex(data)
+
+
+@per_version
+def get_location_index(data):
+    """
+    Returns the LocationIndex of `data`, built once per dataset version.
+    """
+    return LocationIndex(data)
@@ -1,60 +1,42 @@
+import numpy as np
+import pandas as pd
 import streamlit as st
 
-def get_filters_and_data(data):
-    n_filters = 7
-    filters = st.columns(n_filters)
-
-    selected_states = filters[0].multiselect(
-        label="State(s)",
-        options=data['bundesland'].unique(),
-        placeholder='All'
-    )
-    if not selected_states:
-        selected_states = data['bundesland'].unique()
-
-    selected_cities = filters[1].multiselect(
-        label="Cities(s)",
-        options=data['Ort'].unique(),
-        placeholder='All'
-    )
-    if not selected_cities:
-        selected_cities = data['Ort'].unique()
-
-    selected_postalcodes = filters[2].multiselect(
-        label="Postal Codes(s)",
-        options=data['Postleitzahl_2'].unique(),
-        placeholder='All'
-    )
-    if not selected_postalcodes:
-        selected_postalcodes = data['Postleitzahl_2'].unique()
-
-    selected_property_types = filters[3].multiselect(
-        label="Property Type(s)",
-        options=data['Objekttyp'].unique(),
-        placeholder='All'
+from filter_index import FILTER_COLUMNS, get_filter_index, get_location_index, selection_cache
+
+
+def selection_signature(selection):
+    """
+    Canonical, hashable form of a filter selection: one (column, sorted values)
+    pair per filter that is not left at 'All'. Stored in the `attrs` of the
+    filtered frame, where it serves as a cheap cache key together with the
+    dataset version.
+    """
+    return tuple((col, tuple(sorted(map(str, values))))
+                 for col, values in selection.items() if len(values))
+
+
+def filter_multiselect(container, label, col, options, counts, selected):
+    """
+    Multiselect over the `options` of `col` that occur under the other active
+    filters, each labelled with its number of leads. Selected values are always
+    kept in the list.
+    """
+    options = [value for value in options if counts.get(value, 0) or value in selected]
+    return container.multiselect(
+        label=label,
+        options=options,
+        format_func=lambda value: f"{value} ({counts.get(value, 0)})",
+        placeholder='All',
+        key=f"filter_{col}"
     )
-    if not selected_property_types:
-        selected_property_types = data['Objekttyp'].unique()
 
-    sale_guarantee = filters[4].multiselect(
-        label="100-Tage-Verkaufsgarantie",
-        options=data['100-Tage-Verkaufsgarantie'].unique(),
-        placeholder='All'
-    )
-    if not sale_guarantee:
-        sale_guarantee = data['100-Tage-Verkaufsgarantie'].unique()
 
-    # Year of Construction filter
-    year_options = sorted(data['Baujahr'].dropna().unique())
-    selected_years = filters[5].multiselect(
-        label="Year of Construction",
-        options=year_options,
-        placeholder='All'
-    )
-    if not selected_years:
-        selected_years = year_options
+def get_filters_and_data(data):
+    n_filters = 7
+    filters = st.columns(n_filters)
+    index = get_filter_index(data)
 
-    # Property Area filter
     living_area_options = [
         'Up to 800 sqm',
         '800-1100 sqm',
@@ -64,117 +46,133 @@ def get_filters_and_data(data):
         '2000-3000 sqm',
         'Above 3000 sqm'
     ]
-        # sorted(data['property_area_range'].unique())
-    selected_living_area = filters[6].multiselect(
-        label="Property Area",
-        options=living_area_options,
-        placeholder='All'
-    )
 
-    if not selected_living_area:
-        selected_living_area = living_area_options
+    # Read all selections up front, every option list depends on the others
+    selection = {}
+    for col in FILTER_COLUMNS:
+        key = f"filter_{col}"
+        selection[col] = [value for value in st.session_state.get(key, []) if value in index.values[col]]
+        # New options give the widget a new id, which would drop its value: hand it over explicitly
+        st.session_state[key] = selection[col]
+
+    # Dimensions left at 'All' are skipped, except the area, where 'All' still means
+    # the listed ranges (leads outside the bins are left out)
+    signature = selection_signature(selection)
+
+    def compute():
+        return index.facet_counts({**selection,
+                                   'property_area_range': selection['property_area_range'] or living_area_options})
+
+    if data.attrs.get('version') is None:
+        rows, counts = compute()
+    else:
+        rows, counts = selection_cache.get((data.attrs['version'], len(data), signature), compute)
+    counts = {col: dict(zip(index.values[col], counts[col])) for col in FILTER_COLUMNS}
+
+    filter_multiselect(filters[0], "State(s)", 'bundesland', index.values['bundesland'],
+                       counts['bundesland'], selection['bundesland'])
+    filter_multiselect(filters[1], "Cities(s)", 'Ort', index.values['Ort'],
+                       counts['Ort'], selection['Ort'])
+    filter_multiselect(filters[2], "Postal Codes(s)", 'Postleitzahl_2', index.values['Postleitzahl_2'],
+                       counts['Postleitzahl_2'], selection['Postleitzahl_2'])
+    filter_multiselect(filters[3], "Property Type(s)", 'Objekttyp', index.values['Objekttyp'],
+                       counts['Objekttyp'], selection['Objekttyp'])
+    filter_multiselect(filters[4], "100-Tage-Verkaufsgarantie", '100-Tage-Verkaufsgarantie',
+                       index.values['100-Tage-Verkaufsgarantie'], counts['100-Tage-Verkaufsgarantie'],
+                       selection['100-Tage-Verkaufsgarantie'])
 
-    # Filter based on multiselect selections
-    filtered_data = data[
-        (data['bundesland'].isin(selected_states)) &
-        (data['Ort'].isin(selected_cities)) &
-        (data['Postleitzahl_2'].isin(selected_postalcodes)) &
-        (data['Objekttyp'].isin(selected_property_types)) &
-        (data['100-Tage-Verkaufsgarantie'].isin(sale_guarantee)) &
-        (data['Baujahr'].isin(selected_years)) &
-        (data['property_area_range'].isin(selected_living_area))
-        ]
+    # Year of Construction filter
+    year_options = sorted(index.values['Baujahr'].dropna())
+    filter_multiselect(filters[5], "Year of Construction", 'Baujahr', year_options,
+                       counts['Baujahr'], selection['Baujahr'])
+
+    # Property Area filter
+    filter_multiselect(filters[6], "Property Area", 'property_area_range', living_area_options,
+                       counts['property_area_range'], selection['property_area_range'])
+
+    filtered_data = data.take(rows)
+    filtered_data.attrs['selection'] = signature
 
     return filtered_data
 
 
 
-def get_lead_feature_filters(data):
-    filters_row = st.columns((1, 1, 1, 1, 2))
+def presence_condition(flags, selected, present, absent):
+    """
+    Mask for a two-option presence filter ('Provided' / 'No Information') on a
+    precomputed flag column. None when both or neither option is selected.
+    """
+    if (present in selected) == (absent in selected):
+        return None
+    return flags.to_numpy() if present in selected else ~flags.to_numpy()
 
-    selected_city = filters_row[0].selectbox("Select City", data['Ort'].unique())
-    filtered_data = data[data['Ort'] == selected_city]
 
-    selected_region = filters_row[1].selectbox("Select Postal Code", filtered_data['Postleitzahl_2'].unique())
-    filtered_data = filtered_data[filtered_data['Postleitzahl_2'] == selected_region]
+def get_lead_feature_filters(data):
+    filters_row = st.columns((1, 1, 1, 1, 2))
+    cities = get_location_index(data).cities
 
-    selected_name = filters_row[2].multiselect("Select Name", filtered_data['Vorname'].unique(), placeholder='All')
-    if not selected_name:
-        selected_name = filtered_data['Vorname'].unique()
+    selected_city = filters_row[0].selectbox("Select City", list(cities))
+    postcodes = cities.get(selected_city, {})
 
-    selected_id = filters_row[3].multiselect("Select Id", sorted(filtered_data['Id'].unique()), placeholder='All')
-    if not selected_id:
-        selected_id = filtered_data['Id'].unique()
+    selected_region = filters_row[1].selectbox("Select Postal Code", list(postcodes))
+    node = postcodes.get(selected_region)
+    if node is None:
+        return data.iloc[0:0]
 
-    selected_email = filters_row[4].multiselect("Select Email", filtered_data['Email'].unique(), placeholder='All')
-    if not selected_email:
-        selected_email = filtered_data['Email'].unique()
+    selected_name = filters_row[2].multiselect("Select Name", node.names, placeholder='All')
+    selected_id = filters_row[3].multiselect("Select Id", node.ids, placeholder='All')
+    selected_email = filters_row[4].multiselect("Select Email", node.emails, placeholder='All')
 
-    return filtered_data[filtered_data['Vorname'].isin(selected_name) &
-                         filtered_data['Id'].isin(selected_id) &
-                         filtered_data['Email'].isin(selected_email)]
+    # Only the rows of the chosen postcode are looked at
+    rows = node.rows
+    for col, selected in (('Vorname', selected_name), ('Id', selected_id), ('Email', selected_email)):
+        if selected:
+            rows = rows[pd.Series(data[col].to_numpy()[rows]).isin(selected).to_numpy()]
+    return data.take(rows)
 
 
 
 def lead_feature_filters(df):
     feats_filters = st.columns(6)
+    selection = {}
 
     # House Condition filter
     h_cond = feats_filters[0].multiselect(label="House Condition", options=df['Objektzustand'].unique(), placeholder="All")
-    if not h_cond:
-        h_cond = df['Objektzustand'].unique()
+    selection['Objektzustand'] = h_cond
 
     # Equipment Types filter
     h_equip = feats_filters[1].multiselect(label="Equipment Types", options=df['Ausstattung'].unique(), placeholder="All")
-    if not h_equip:
-        h_equip = df['Ausstattung'].unique()
+    selection['Ausstattung'] = h_equip
 
     # File Attached filter
     h_files = feats_filters[2].multiselect(label="File Attached", options=['Attached', 'Not Attached'], placeholder="All")
-    if not h_files:
-        h_files = ['Attached', 'Not Attached']
+    selection['Anhaenge/Dateien'] = h_files
 
     # Nachricht filter
     h_msg = feats_filters[3].multiselect(label="Nachricht", options=['Provided', 'No Message'], placeholder="All")
-    if not h_msg:
-        h_msg = ['Provided', 'No Message']
+    selection['Nachricht'] = h_msg
 
     # Besonderen Rechten filter
     h_ap_rights = feats_filters[4].multiselect(label="Besonderen Rechten", options=['Provided', 'No Information'], placeholder="All")
-    if not h_ap_rights:
-        h_ap_rights = ['Provided', 'No Information']
+    selection['Informationen zu besonderen Rechten'] = h_ap_rights
 
     # Schaeden filter
     h_defects = feats_filters[5].multiselect(label="Schaeden", options=['Provided', 'No Information'], placeholder="All")
-    if not h_defects:
-        h_defects = ['Provided', 'No Information']
-
-    # House condition and equipment type filters
-    filtered_data = df[df['Objektzustand'].isin(h_cond) &
-                       df['Ausstattung'].isin(h_equip)]
-
-    # File attached filter: Handle the 'Anhaenge/Dateien' column
-    if 'Attached' in h_files and 'Not Attached' not in h_files:
-        filtered_data = filtered_data[filtered_data['Anhaenge/Dateien'] != 'No Information']
-    elif 'Not Attached' in h_files and 'Attached' not in h_files:
-        filtered_data = filtered_data[filtered_data['Anhaenge/Dateien'] == 'No Information']
-
-    # Nachricht filter: Handle the 'Nachricht' column
-    if 'Provided' in h_msg and 'No Message' not in h_msg:
-        filtered_data = filtered_data[filtered_data['Nachricht'] != 'No Information']
-    elif 'No Message' in h_msg and 'Provided' not in h_msg:
-        filtered_data = filtered_data[filtered_data['Nachricht'] == 'No Information']
-
-    # Besonderen Rechten filter: Handle the 'Informationen zu besonderen Rechten' column
-    if 'Provided' in h_ap_rights and 'No Information' not in h_ap_rights:
-        filtered_data = filtered_data[filtered_data['Informationen zu besonderen Rechten'] != 'No Information']
-    elif 'No Information' in h_ap_rights and 'Provided' not in h_ap_rights:
-        filtered_data = filtered_data[filtered_data['Informationen zu besonderen Rechten'] == 'No Information']
-
-    # Schaeden filter: Handle the 'Schaeden/Maengel' column
-    if 'Provided' in h_defects and 'No Information' not in h_defects:
-        filtered_data = filtered_data[filtered_data['Schaeden/Maengel'] != 'No Information']
-    elif 'No Information' in h_defects and 'Provided' not in h_defects:
-        filtered_data = filtered_data[filtered_data['Schaeden/Maengel'] == 'No Information']
-
+    selection['Schaeden/Maengel'] = h_defects
+
+    # All feature filters are combined into one mask, so the frame is sliced once
+    conditions = [presence_condition(df['has_anhaenge'], h_files, 'Attached', 'Not Attached'),
+                  presence_condition(df['has_nachricht'], h_msg, 'Provided', 'No Message'),
+                  presence_condition(df['has_besondere_rechte'], h_ap_rights, 'Provided', 'No Information'),
+                  presence_condition(df['has_schaeden'], h_defects, 'Provided', 'No Information')]
+    if h_cond:
+        conditions.append(df['Objektzustand'].isin(h_cond).to_numpy())
+    if h_equip:
+        conditions.append(df['Ausstattung'].isin(h_equip).to_numpy())
+    conditions = [condition for condition in conditions if condition is not None]
+
+    filtered_data = df[np.logical_and.reduce(conditions)] if conditions else df.copy(deep=False)
+
+    # Extends the signature of the incoming selection, so a narrowed result never shares a cache key with `df`
+    filtered_data.attrs['selection'] = df.attrs.get('selection', ()) + selection_signature(selection)
     return filtered_data
@@ -0,0 +1,154 @@
+import hashlib
+import io
+import logging
+import os
+import zipfile
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import requests
+
+GEO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'geo')
+# GeoNames postal codes of Germany (CC BY 4.0), one row per postcode and place
+SOURCE_URL = 'https://download.geonames.org/export/zip/DE.zip'
+SOURCE_FILE = 'DE.txt'
+SOURCE_COLUMNS = ['country', 'postleitzahl', 'ort', 'state', 'state_code', 'district', 'district_code',
+                  'community', 'community_code', 'lat', 'lon', 'accuracy']
+GAZETTEER_FILE = 'plz_centroids.csv'
+
+
+def _path():
+    return os.path.join(GEO_DIR, GAZETTEER_FILE)
+
+
+def _per_distinct(values, normalize):
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=False)
+    return normalize(pd.Series(uniques, dtype=object))[codes]
+
+
+def normalize_postcode(values):
+    """
+    Five-digit postcode strings ('1067' and 1067.0 -> '01067'), None where the
+    value is not a postcode.
+    """
+    def normalize(uniques):
+        numbers = pd.to_numeric(uniques, errors='coerce')
+        valid = numbers.between(1000, 99999) & (numbers == np.trunc(numbers))
+        return numbers.where(valid).map('{:05.0f}'.format, na_action='ignore').to_numpy(dtype=object)
+    return _per_distinct(values, normalize)
+
+
+def normalize_place(values):
+    return _per_distinct(values, lambda uniques: uniques.astype(str).str.strip().str.lower().to_numpy(dtype=object))
+
+
+def _read_source(path):
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return pd.read_csv(io.BytesIO(archive.read(SOURCE_FILE)), sep='\t', header=None,
+                               names=SOURCE_COLUMNS, dtype={'postleitzahl': str})
+    return pd.read_csv(path, sep='\t', header=None, names=SOURCE_COLUMNS, dtype={'postleitzahl': str})
+
+
+def build_gazetteer(source=None):
+    """
+    Writes the postcode centroid table to `GEO_DIR`: the mean coordinates of the
+    places of each postcode, per postcode and place name. The GeoNames export
+    is read from `source` (DE.txt or DE.zip) if given, else from the copy in
+    `GEO_DIR`, and only downloaded when neither exists.
+
+    This is a maintenance step (`python gazetteer.py`), the app itself only
+    reads the generated table, which is committed with the code.
+    """
+    os.makedirs(GEO_DIR, exist_ok=True)
+    source_path = source or os.path.join(GEO_DIR, SOURCE_FILE)
+    if not os.path.exists(source_path):
+        response = requests.get(SOURCE_URL, timeout=30)
+        response.raise_for_status()
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            with open(source_path, 'wb') as f:
+                f.write(archive.read(SOURCE_FILE))
+
+    places = _read_source(source_path)
+    places['postleitzahl'] = normalize_postcode(places['postleitzahl'])
+    centroids = (places.dropna(subset=['postleitzahl', 'lat', 'lon'])
+                 .groupby(['postleitzahl', 'ort'], as_index=False)[['lat', 'lon']].mean()
+                 .round({'lat': 5, 'lon': 5}))
+    tmp_path = f"{_path()}.tmp"
+    centroids.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, _path())
+    print(f"{centroids['postleitzahl'].nunique()} postcodes, {len(centroids)} places, "
+          f"{os.path.getsize(_path()) / 1024:.0f} KiB")
+
+
+class Gazetteer:
+    """
+    Offline lookup of lead coordinates: the centroid of the postcode, or of the
+    place name when the postcode is unknown. `stamp` identifies the table the
+    coordinates come from, None for an empty gazetteer.
+    """
+
+    def __init__(self, centroids, stamp=None):
+        postcodes = centroids.groupby('postleitzahl')[['lat', 'lon']].mean()
+        places = centroids.assign(ort=normalize_place(centroids['ort'])).groupby('ort')[['lat', 'lon']].mean()
+        self.postcodes = postcodes
+        self.places = places
+        self.stamp = stamp
+
+    def __len__(self):
+        return len(self.postcodes)
+
+    def locate(self, postleitzahl, ort):
+        """
+        Latitude and longitude (float32 arrays, NaN where unknown) of the leads
+        with the given postcodes and places. Each distinct postcode and place is
+        looked up once.
+        """
+        by_postcode = self._lookup(self.postcodes, normalize_postcode(postleitzahl))
+        by_place = self._lookup(self.places, normalize_place(ort))
+        coordinates = np.where(np.isnan(by_postcode), by_place, by_postcode)
+        return coordinates[:, 0], coordinates[:, 1]
+
+    @staticmethod
+    def _lookup(table, keys):
+        codes, uniques = pd.factorize(keys)
+        coordinates = table.reindex(uniques).to_numpy(dtype=np.float32)
+        # Missing keys have the code -1 and pick up the trailing NaN row
+        return np.vstack([coordinates, np.full((1, 2), np.nan, dtype=np.float32)])[codes]
+
+
+@lru_cache(maxsize=1)
+def _read_gazetteer(path, mtime, size):
+    with open(path, 'rb') as f:
+        content = f.read()
+    centroids = pd.read_csv(io.BytesIO(content), dtype={'postleitzahl': str})
+    return Gazetteer(centroids, stamp=hashlib.sha1(content).hexdigest()[:16])
+
+
+@lru_cache(maxsize=1)
+def _empty_gazetteer():
+    return Gazetteer(pd.DataFrame({'postleitzahl': [], 'ort': [], 'lat': [], 'lon': []}).astype(
+        {'postleitzahl': object, 'ort': object, 'lat': float, 'lon': float}))
+
+
+def load_gazetteer():
+    """
+    Returns the Gazetteer of the postcode centroid table shipped in `GEO_DIR`,
+    read from disk once per process and again when the file changes. Nothing
+    is downloaded at runtime; `python gazetteer.py` rebuilds the table.
+
+    Without the table the gazetteer is empty (its stamp is None), so every lead
+    stays without coordinates instead of the processing failing.
+    """
+    try:
+        stat = os.stat(_path())
+    except OSError:
+        logging.warning("The postcode gazetteer is missing from %s, build it with `python gazetteer.py`", GEO_DIR)
+        return _empty_gazetteer()
+    return _read_gazetteer(_path(), stat.st_mtime_ns, stat.st_size)
+
+
+if __name__ == '__main__':
+    import sys
+    build_gazetteer(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+
+import numpy as np
+import requests
+import streamlit as st
+
+GEO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'geo')
+SOURCE_URL = 'https://raw.githubusercontent.com/isellsoap/deutschlandGeoJSON/main/2_bundeslaender/2_hoch.geo.json'
+SOURCE_FILE = 'bundeslaender_source.geo.json'
+
+# Douglas-Peucker tolerance in degrees (~1 km per 0.01°); None keeps every vertex
+RESOLUTIONS = {'low': 0.02, 'medium': 0.005, 'high': None}
+COORD_DECIMALS = 5
+
+
+def _path(resolution):
+    return os.path.join(GEO_DIR, f"bundeslaender_{resolution}.geo.json")
+
+
+def simplify_ring(ring, tolerance):
+    """
+    Douglas-Peucker simplification of a closed ring of [lon, lat] points.
+    Rings that would collapse below a valid polygon are returned unchanged.
+    """
+    points = np.asarray(ring, dtype=float)
+    if tolerance is None or len(points) <= 4:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        idx = int(np.argmax(distances))
+        if distances[idx] > tolerance:
+            split = start + 1 + idx
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+    simplified = points[keep]
+    return simplified if len(simplified) >= 4 else points
+
+
+def simplify_geojson(geojson, tolerance):
+    """
+    Returns a copy of a Polygon/MultiPolygon FeatureCollection with every ring
+    simplified and the coordinates rounded to `COORD_DECIMALS`.
+    """
+    def polygon(rings):
+        return [np.round(simplify_ring(ring, tolerance), COORD_DECIMALS).tolist() for ring in rings]
+
+    features = []
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            coordinates = polygon(geometry['coordinates'])
+        else:
+            coordinates = [polygon(rings) for rings in geometry['coordinates']]
+        features.append({**feature, 'geometry': {'type': geometry['type'], 'coordinates': coordinates}})
+    return {**geojson, 'features': features}
+
+
+def vertex_count(geojson):
+    count = 0
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        count += sum(len(ring) for rings in polygons for ring in rings)
+    return count
+
+
+def build_boundaries(source=None):
+    """
+    Writes the low/medium/high resolution boundary files to `GEO_DIR`. The source
+    GeoJSON is read from `source` (a local file) if given, else from the copy in
+    `GEO_DIR`, and only downloaded when neither exists.
+
+    This is a maintenance step (`python geo.py`), the app itself only reads the
+    generated files, which are committed with the code.
+    """
+    os.makedirs(GEO_DIR, exist_ok=True)
+    source_path = source or os.path.join(GEO_DIR, SOURCE_FILE)
+    if os.path.exists(source_path):
+        with open(source_path, encoding='utf-8') as f:
+            geojson = json.load(f)
+    else:
+        response = requests.get(SOURCE_URL, timeout=30)
+        response.raise_for_status()
+        geojson = response.json()
+        with open(source_path, 'w', encoding='utf-8') as f:
+            json.dump(geojson, f)
+
+    for resolution, tolerance in RESOLUTIONS.items():
+        simplified = simplify_geojson(geojson, tolerance)
+        tmp_path = f"{_path(resolution)}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(simplified, f, separators=(',', ':'))
+        os.replace(tmp_path, _path(resolution))
+        print(f"{resolution}: {vertex_count(simplified)} vertices, "
+              f"{os.path.getsize(_path(resolution)) / 1024:.0f} KiB")
+
+
+@st.cache_resource
+def _read_states(resolution):
+    with open(_path(resolution), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_states(resolution='medium'):
+    """
+    Returns the Bundesland boundaries as a GeoJSON FeatureCollection (feature
+    name in `properties.name`), read from the files shipped in `GEO_DIR` once
+    per process. Nothing is downloaded at runtime; `python geo.py` rebuilds
+    the files.
+
+    A missing file gives an empty collection, so the maps render without shapes
+    instead of failing. It is not cached, so the file is picked up once it exists.
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution '{resolution}', expected one of {list(RESOLUTIONS)}")
+    try:
+        return _read_states(resolution)
+    except FileNotFoundError:
+        logging.warning("Bundesland boundaries are missing from %s, build them with `python geo.py`", GEO_DIR)
+        return {'type': 'FeatureCollection', 'features': []}
+
+
+def state_anchors(resolution='low'):
+    """
+    Returns the point the leads of each Bundesland are placed at on the maps,
+    the first vertex of its boundary, as a dict of name -> (lat, lon).
+    """
+    anchors = {}
+    for feature in load_states(resolution)['features']:
+        geometry = feature['geometry']
+        rings = geometry['coordinates'][0] if geometry['type'] == 'MultiPolygon' else geometry['coordinates']
+        lon, lat = rings[0][0]
+        anchors.setdefault(feature['properties']['name'], (lat, lon))
+    return anchors
+
+
+if __name__ == '__main__':
+    import sys
+    build_boundaries(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,101 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import per_version
+
+# Share of changed leads above which an index is rebuilt instead of patched
+REBUILD_FRACTION = 0.2
+
+
+def changed_ids(previous, state):
+    """
+    Ids of the leads that are new or whose entry differs between the per-Id
+    states `previous` and `state` (Series or DataFrames indexed by Id), and the
+    Ids that disappeared.
+    """
+    positions = previous.index.get_indexer(state.index)
+    known = positions >= 0
+    values, previous_values = state.to_numpy(), previous.to_numpy()[positions[known]]
+    differs = ~known
+    unequal = values[known] != previous_values
+    differs[known] = unequal.any(axis=1) if unequal.ndim > 1 else unequal
+    return state.index[differs], previous.index.difference(state.index)
+
+
+class PatchedIndex:
+    """
+    Base of the lead indexes that follow the dataset by patching.
+
+    The bulk of an index is an immutable segment built in one vectorized pass
+    (`_build`). Leads that changed are kept in a small delta segment on top of
+    it (`_patch`), with their superseded entries masked out of the bulk segment
+    through `alive`. `sync` compares a per-Id state of the leads (`_state`, e.g.
+    content hashes) with the one last indexed to find the changed and dropped
+    leads; the whole index is rebuilt once the changes exceed
+    `REBUILD_FRACTION` of it.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._indexed = None
+        self._lock = threading.Lock()
+
+    def _set_bulk(self, ids):
+        """
+        Takes `ids` as the leads of a freshly built bulk segment, all alive.
+        """
+        self.ids = ids
+        self._positions = pd.Index(ids)
+        self.alive = np.ones(len(ids), dtype=bool)
+        self._n_changed = 0
+
+    def _mask(self, ids):
+        """
+        Masks the bulk entries of `ids` out.
+        """
+        positions = self._positions.get_indexer(ids)
+        self.alive[positions[positions >= 0]] = False
+
+    def sync(self, data):
+        """
+        Brings the index up to date with `data` (the processed leads frame).
+        A frame with the version already indexed is skipped.
+        """
+        version = data.attrs.get('version')
+        with self._lock:
+            if version is not None and version == self.version:
+                return
+            state = self._state(data)
+            if self._indexed is None:
+                self._build(data, state)
+            else:
+                changed, removed = changed_ids(self._indexed, state)
+                self._n_changed += len(changed) + len(removed)
+                if self._n_changed > REBUILD_FRACTION * max(len(self.ids), 1):
+                    self._build(data, state)
+                elif len(changed) or len(removed):
+                    self._patch(data, state, changed, removed)
+            self._indexed = state
+            self.version = version
+
+
+@per_version
+def _lead_positions(data):
+    """
+    Row position in `data` of each Id (its last row), as a Series indexed by Id.
+    """
+    ids = pd.Index(data['Id'].to_numpy())
+    last = ~ids.duplicated(keep='last')
+    return pd.Series(np.flatnonzero(last), index=ids[last])
+
+
+def lead_rows(data, ids):
+    """
+    The rows of the leads `ids` in `data`, in the order of `ids`, looked up
+    through an Id index built once per dataset version. Ids no longer in
+    `data` are left out.
+    """
+    positions = _lead_positions(data).reindex(ids).dropna()
+    return data.iloc[positions.to_numpy(dtype=np.int64)]
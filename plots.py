@@ -1,13 +1,15 @@
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-import requests
 import plotly.express as px
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 
+from dataset_cache import dataset_cache, shared_state
+from feature_ages import FEATURE_COLUMNS, FeatureAges, feature_age_bucket, grouped_feature_means
+from geo import load_states, state_anchors
+from lead_cube import lead_cube
 from utils import format_fig_layout
-import streamlit as st
 
 colors = ["#264653", "#2a9d8f", "#e9c46a", "#f4a261", "#e76f51", "#84a59d", "#006d77",
           "#f6bd60", "#90be6d", "#577590", "#e07a5f", "#81b29a", "#f2cc8f", "#0081a7"]
@@ -19,8 +21,8 @@ g_colors = {
 }
 
 def leads_by_location(data):
-    data['Postcode (first 2 digits)'] = data['Postleitzahl'].astype(str).str[:2]
-    leads_by_postcode = data.groupby(['bundesland','Ort', 'Postcode (first 2 digits)'])['Id'].count().reset_index()
+    cube = lead_cube(data)
+    leads_by_postcode = cube.groupby(['bundesland','Ort', 'Postcode (first 2 digits)'], observed=True)['Id'].sum().reset_index()
     leads_by_postcode.columns = ['State', 'City', 'Postcode', 'Number of Leads']
     leads_by_postcode = leads_by_postcode.sort_values(by='State')
     fig = go.Figure(data=[go.Table(
@@ -50,7 +52,7 @@ def leads_by_location(data):
 
 
 def property_type_breakdown(data):
-    type_data = data.groupby(['Objekttyp', 'Haustyp'], observed=False)['Id'].count().reset_index()
+    type_data = lead_cube(data).groupby(['Objekttyp', 'Haustyp'], observed=True)['Id'].sum().reset_index()
     pivot_data = type_data.pivot(index='Objekttyp', columns='Haustyp', values='Id').fillna(0)
     wrapped_labels = [label.replace(' ', '<br>') if len(label) > 10 else label for label in pivot_data.index]  # Example wrapping logic
 
@@ -103,10 +105,10 @@ def property_type_breakdown(data):
 
 
 def property_units_breakdown(data):
-    units_data = data.groupby('Objekttyp').agg({
+    units_data = lead_cube(data).groupby('Objekttyp', observed=True).agg({
         'Wohneinheiten': 'sum',
         'Gewerbeeinheiten': 'sum',
-        'Id': 'count'
+        'Id': 'sum'
     }).reset_index()
 
     units_data['Total'] = units_data['Wohneinheiten'] + units_data['Gewerbeeinheiten'] + units_data['Id']
@@ -183,8 +185,8 @@ def property_units_breakdown(data):
 
 
 def leads_treemap(data):
-    bundesland_data = data.groupby('bundesland').agg(
-        Total_Leads=('Id', 'count'),                  # Count of leads (Id)
+    bundesland_data = lead_cube(data).groupby('bundesland', observed=True).agg(
+        Total_Leads=('Id', 'sum'),                    # Count of leads (Id)
         Total_Cities=('Ort', 'nunique'),              # Count of unique cities (Ort)
         Total_Lot_Area=('Grundstueckflaeche', 'sum')  # Sum of lot area
     ).reset_index()
@@ -232,34 +234,8 @@ def leads_treemap(data):
 
 
 def leads_features_heatmap(df, col):
-    features = ['Dach', 'Fenster', 'Leitungen', 'Heizung', 'Fassade', 'Badezimmer', 'Innenausbau', 'Grundrissgestaltung']
-    df = df[[col] + features]
-    df = df.fillna('keine')
-
-    years_mapping = {
-        "0-5 Jahre": 0,
-        "5-10 Jahre": 5,
-        "10-15 Jahre": 10,
-        "mehr als 15 Jahre": 15,
-        "keine": None
-    }
-
-    def inverse_map(avg_cond):
-        if 0 <= avg_cond < 5:
-            return "0-5 Jahre"
-        elif 5 <= avg_cond < 10:
-            return "5-10 Jahre"
-        if 10 <= avg_cond < 15:
-            return "10-15 Jahre"
-        elif avg_cond >=15:
-            return "mehr als 15 Jahre"
-        else:
-            return "keine"
-
-    for feature in features:
-        df[feature] = df[feature].map(years_mapping)
-
-    heatmap_data = df.groupby(col).mean().reset_index()
+    matrix = shared_state(FeatureAges).matrix_of(df)
+    heatmap_data = grouped_feature_means(matrix, df[col]).reset_index()
     transposed_data = heatmap_data.set_index(col).T
 
     fig = go.Figure(data=go.Heatmap(
@@ -267,7 +243,7 @@ def leads_features_heatmap(df, col):
         x=heatmap_data[col],
         y=transposed_data.index,
         hovertemplate='<b>%{x}</b><br>Feature: %{y} <br>Avg. Usage: %{z} years<extra></extra>',
-        customdata=[[inverse_map(val) for val in row][::-1] for row in transposed_data.values],
+        customdata=[[feature_age_bucket(val) for val in row][::-1] for row in transposed_data.values],
         colorscale=[
             [0.0, '#d9ed92'],  # Corresponds to '0-5 Jahre'
             [0.25, '#99d98c'],  # Corresponds to '5-10 Jahre'
@@ -297,7 +273,9 @@ def leads_features_heatmap(df, col):
 
 
 def lead_count_pie_chart(data):
-    lead_data = data['Objekttyp'].value_counts().reset_index()
+    # All property types, as value_counts would count them, so ties keep their order
+    lead_counts = lead_cube(data).groupby('Objekttyp', observed=False)['Id'].sum()
+    lead_data = lead_counts.sort_values(ascending=False).loc[lambda counts: counts > 0].reset_index()
     lead_data.columns = ['Objekttyp', 'Lead Count']
 
     non_zero_units = lead_data[lead_data['Lead Count']>0]
@@ -332,7 +310,7 @@ def lead_count_pie_chart(data):
 
 
 def residential_units_pie_chart(data):
-    residential_data = data.groupby('Objekttyp')['Wohneinheiten'].sum().reset_index()
+    residential_data = lead_cube(data).groupby('Objekttyp', observed=True)['Wohneinheiten'].sum().reset_index()
     residential_data = residential_data.sort_values(by='Wohneinheiten', ascending=False)
 
     non_zero_units = residential_data[residential_data['Wohneinheiten']>0]
@@ -365,7 +343,7 @@ def residential_units_pie_chart(data):
 
 
 def commercial_units_pie_chart(data):
-    commercial_data = data.groupby('Objekttyp')['Gewerbeeinheiten'].sum().reset_index()
+    commercial_data = lead_cube(data).groupby('Objekttyp', observed=True)['Gewerbeeinheiten'].sum().reset_index()
     commercial_data = commercial_data.sort_values(by='Gewerbeeinheiten', ascending=False)
 
     non_zero_units = commercial_data[commercial_data['Gewerbeeinheiten']>0]
@@ -413,7 +391,7 @@ def show_indicator(value, label, title):
 
 
 def conversion_channels_dist(data):
-    channel_counts = data['Quelle'].value_counts()
+    channel_counts = data['Quelle'].value_counts().loc[lambda counts: counts > 0]
 
     fig = go.Figure(data=go.Pie(
         labels=channel_counts.index,
@@ -611,17 +589,16 @@ def leads_registration_overtime(data):
     return fig
 
 
-@st.cache_data
+@dataset_cache
 def geographic_listing_analytics(df):
-    listing_data = df.groupby('bundesland').agg(
+    listing_data = df.groupby('bundesland', observed=True).agg(
         total_ids=('Id', 'count'),
         total_lot_area=('Grundstueckflaeche', 'sum')
     ).reset_index()
 
     listing_data = listing_data.rename({'total_ids': 'Registered Leads', 'total_lot_area': 'Net Lot Area'}, axis=1)
 
-    url = 'https://raw.githubusercontent.com/isellsoap/deutschlandGeoJSON/main/2_bundeslaender/2_hoch.geo.json'
-    geojson = requests.get(url).json()
+    geojson = load_states('medium')
 
     fig = px.choropleth_mapbox(
         listing_data,
@@ -658,74 +635,86 @@ def geographic_listing_analytics(df):
     return fig
 
 
-@st.cache_data
+# Markers shipped to the browser at most (plus one per location left out); the cluster bubbles still count every lead
+MAX_MAP_MARKERS = 5000
+
+# Builds the marker of one row [lat, lon, Id, area, owner name, city, leads] of the cluster data in the browser
+LEAD_MARKER_CALLBACK = """
+var callback = function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {leads: row[6]});
+    marker.bindPopup("<b>Lead ID:</b> " + row[2] + "<br>" +
+                     "<b>Property Area:</b> " + row[3] + " sqm<br>" +
+                     "<b>Owner Name:</b> " + row[4], {maxWidth: 300});
+    marker.bindTooltip(String(row[5]));
+    return marker;
+};
+"""
+
+# The default cluster icon, labelled with the number of leads its markers stand for
+LEAD_CLUSTER_ICON = """
+function (cluster) {
+    var leads = 0;
+    cluster.getAllChildMarkers().forEach(function (marker) { leads += marker.options.leads; });
+    leads = Math.round(leads);
+    var size = leads < 10 ? 'small' : (leads < 100 ? 'medium' : 'large');
+    return L.divIcon({html: '<div><span>' + leads + '</span></div>', className: 'marker-cluster marker-cluster-' + size,
+                      iconSize: new L.Point(40, 40)});
+}
+"""
+
+
+@dataset_cache
 def leads_cluster_map(df):
-    geojson_url = 'https://raw.githubusercontent.com/isellsoap/deutschlandGeoJSON/main/2_bundeslaender/2_hoch.geo.json'
-    geojson = requests.get(geojson_url).json()
+    anchors = state_anchors('low')
 
     folium_map = folium.Map(location=[51.1657, 10.4515], zoom_start=6, width='100%', height='100%')
-    marker_cluster = MarkerCluster().add_to(folium_map)
-
-    for _, row in df.iterrows():
-        for feature in geojson['features']:
-            if feature['properties']['name'] == row['bundesland']:
-                geometry_type = feature['geometry']['type']
-                coords = feature['geometry']['coordinates']
-
-                if geometry_type == 'MultiPolygon':
-                    lon, lat = coords[0][0][0]  # [lon, lat] format
-                elif geometry_type == 'Polygon':
-                    lon, lat = coords[0][0]  # [lon, lat] format
-
-                folium.Marker(
-                    location=[lat, lon],
-                    popup=folium.Popup(
-                        f"<b>Lead ID:</b> {row['Id']}<br>"
-                        f"<b>Property Area:</b> {round(row['Grundstueckflaeche'],2)} sqm<br>"
-                        f"<b>Owner Name:</b> {row['Vorname']} {row['Nachname']}",
-                        max_width=300
-                    ),
-                    tooltip=row['Ort']
-                ).add_to(marker_cluster)
-                break
 
+    # Leads are placed at the coordinates of their postcode; without them at the anchor point of their
+    # Bundesland, and leads of unknown states without coordinates get no marker
+    states = pd.Index(list(anchors), dtype=object).get_indexer(df['bundesland'].to_numpy(dtype=object))
+    anchor_points = np.vstack([np.array(list(anchors.values()), dtype=float).reshape(-1, 2), [[np.nan, np.nan]]])
+    points = anchor_points[states]
+    if 'lat' in df.columns:
+        located = df['lat'].notna().to_numpy()
+        points[located] = df[['lat', 'lon']].to_numpy(dtype=float)[located]
+    rows = np.flatnonzero(~np.isnan(points[:, 0]))
+    # Leads at the same point (a postcode centroid or a state anchor) form a location
+    groups, _ = pd.factorize(points[rows, 0] + 1j * points[rows, 1])
+    leads_per_group = np.bincount(groups)
+
+    # Above MAX_MAP_MARKERS only the newest leads of each location get a marker, at least one per location,
+    # and each marker stands for its share of the leads at its location, so a cluster counts the leads under
+    # it. Undated leads rank as the oldest (NaT is the smallest int64)
+    if len(rows) > MAX_MAP_MARKERS:
+        created = df['Created_at'].to_numpy(dtype='datetime64[ns]').view(np.int64)[rows]
+        order = np.argsort(created, kind='stable')[::-1]
+        rows, groups = rows[order], groups[order]
+        quota = np.maximum(1, leads_per_group * MAX_MAP_MARKERS // len(rows))
+        rank = pd.Series(groups).groupby(groups).cumcount().to_numpy()
+        keep = rank < quota[groups]
+        order = np.argsort(rows[keep], kind='stable')
+        rows, groups = rows[keep][order], groups[keep][order]
+    markers_per_group = np.bincount(groups, minlength=len(leads_per_group))
+
+    leads, points = df.iloc[rows], points[rows]
+    weights = leads_per_group[groups] / markers_per_group[groups]
+    owners = leads['Vorname'].astype(str) + ' ' + leads['Nachname'].astype(str)
+    data = list(zip(points[:, 0].tolist(), points[:, 1].tolist(), leads['Id'].tolist(),
+                    leads['Grundstueckflaeche'].round(2).tolist(), owners.tolist(), leads['Ort'].astype(str).tolist(),
+                    weights.tolist()))
+
+    FastMarkerCluster(data, callback=LEAD_MARKER_CALLBACK, icon_create_function=LEAD_CLUSTER_ICON).add_to(folium_map)
     return folium_map
 
 
-@st.cache_data
+@dataset_cache
 def germany_feature_conditions_choropleth(df):
-    features = ['Dach', 'Fenster', 'Leitungen', 'Heizung', 'Fassade', 'Badezimmer', 'Innenausbau', 'Grundrissgestaltung']
-    df = df[['bundesland'] + features]
-    df = df.fillna('keine')
-
-    years_mapping = {
-        "0-5 Jahre": 0,
-        "5-10 Jahre": 5,
-        "10-15 Jahre": 10,
-        "mehr als 15 Jahre": 15,
-        "keine": None
-    }
-    def inverse_map(avg_cond):
-        if 0 <= avg_cond < 5:
-            return "0-5 Jahre"
-        elif 5 <= avg_cond < 10:
-            return "5-10 Jahre"
-        if 10 <= avg_cond < 15:
-            return "10-15 Jahre"
-        elif avg_cond >= 15:
-            return "mehr als 15 Jahre"
-        else:
-            return "keine"
-
-    for feature in features:
-        df[feature] = df[feature].map(years_mapping)
+    matrix = shared_state(FeatureAges).matrix_of(df)
+    avg_feature_data = grouped_feature_means(matrix, df['bundesland']).reset_index()
+    avg_feature_data['Avg_Condition'] = avg_feature_data[FEATURE_COLUMNS].mean(axis=1)
+    avg_feature_data['Condition_Category'] = avg_feature_data['Avg_Condition'].apply(feature_age_bucket)
 
-    avg_feature_data = df.groupby('bundesland').mean().reset_index()
-    avg_feature_data['Avg_Condition'] = avg_feature_data[features].mean(axis=1)
-    avg_feature_data['Condition_Category'] = avg_feature_data['Avg_Condition'].apply(inverse_map)
-
-    url = 'https://raw.githubusercontent.com/isellsoap/deutschlandGeoJSON/main/2_bundeslaender/2_hoch.geo.json'
-    geojson = requests.get(url).json()
+    geojson = load_states('medium')
 
     fig = px.choropleth_mapbox(
         avg_feature_data,
@@ -773,48 +762,19 @@ def germany_feature_conditions_choropleth(df):
     return fig
 
 
-@st.cache_data
+@dataset_cache
 def avg_feature_condition_table(df, col='City'):
-    features = ['Dach', 'Fenster', 'Leitungen', 'Heizung', 'Fassade', 'Badezimmer', 'Innenausbau', 'Grundrissgestaltung']
     main_col = 'Ort' if col == 'City' else 'Postleitzahl_2'
 
-    df = df[[main_col] + features]
-    df = df.fillna('keine')
-
-    # Map years to numeric values for computing averages
-    years_mapping = {
-        "0-5 Jahre": 0,
-        "5-10 Jahre": 5,
-        "10-15 Jahre": 10,
-        "mehr als 15 Jahre": 15,
-        "keine": None
-    }
-
-    # Helper function to reverse map the averages back to textual descriptions
-    def inverse_map(avg_cond):
-        if 0 <= avg_cond < 5:
-            return "0-5 Jahre"
-        elif 5 <= avg_cond < 10:
-            return "5-10 Jahre"
-        if 10 <= avg_cond < 15:
-            return "10-15 Jahre"
-        elif avg_cond >= 15:
-            return "mehr als 15 Jahre"
-        else:
-            return "keine"
-
-    # Apply the mapping to each feature
-    for feature in features:
-        df[feature] = df[feature].map(years_mapping)
-
     # Calculate the average condition for each feature by the specified column (Ort or Postleitzahl_2)
-    avg_feature_data = df.groupby(main_col).mean().reset_index()
+    matrix = shared_state(FeatureAges).matrix_of(df)
+    avg_feature_data = grouped_feature_means(matrix, df[main_col]).reset_index()
 
     # Compute overall average condition
-    avg_feature_data['Avg_Condition'] = avg_feature_data[features].mean(axis=1)
+    avg_feature_data['Avg_Condition'] = avg_feature_data[FEATURE_COLUMNS].mean(axis=1)
 
     # Map the average condition back to textual categories
-    avg_feature_data['Condition_Category'] = avg_feature_data['Avg_Condition'].apply(inverse_map)
+    avg_feature_data['Condition_Category'] = avg_feature_data['Avg_Condition'].apply(feature_age_bucket)
 
     # Color mapping based on condition categories
     def color_mapping(x):
@@ -858,7 +818,7 @@ def avg_feature_condition_table(df, col='City'):
     return fig
 
 
-@st.cache_data
+@dataset_cache
 def house_condition_choropleth(data):
     condition_mapping = {
         "gut": 5,
@@ -883,15 +843,14 @@ def house_condition_choropleth(data):
         elif 4<x<=5:
             return "gut"
 
-    data['Objektzustand_num'] = data['Objektzustand'].map(condition_mapping)
-    avg_feature_data = data.groupby('bundesland')['Objektzustand_num'].mean().reset_index().rename({
+    data['Objektzustand_num'] = data['Objektzustand'].map(condition_mapping).astype(float)
+    avg_feature_data = data.groupby('bundesland', observed=True)['Objektzustand_num'].mean().reset_index().rename({
         "Objektzustand_num":"Avg_Condition"
     }, axis=1)
     avg_feature_data['Condition'] = avg_feature_data['Avg_Condition'].apply(inverse_map)
     reverse_mapping = {v: k for k, v in condition_mapping.items()}
 
-    url = 'https://raw.githubusercontent.com/isellsoap/deutschlandGeoJSON/main/2_bundeslaender/2_hoch.geo.json'
-    geojson = requests.get(url).json()
+    geojson = load_states('medium')
 
     fig = px.choropleth_mapbox(
         avg_feature_data,
@@ -929,7 +888,7 @@ def house_condition_choropleth(data):
     return fig
 
 
-@st.cache_data
+@dataset_cache
 def house_condition_table(data, col='City'):
     main_col = 'Ort' if col=='City' else 'Postleitzahl_2'
     condition_mapping = {
@@ -942,8 +901,8 @@ def house_condition_table(data, col='City'):
     }
 
     reverse_condition_mapping = {v: k for k, v in condition_mapping.items()}
-    data['Objektzustand_num'] = data['Objektzustand'].map(condition_mapping)
-    avg_feature_data = data.groupby(main_col)['Objektzustand_num'].mean().reset_index().rename({
+    data['Objektzustand_num'] = data['Objektzustand'].map(condition_mapping).astype(float)
+    avg_feature_data = data.groupby(main_col, observed=True)['Objektzustand_num'].mean().reset_index().rename({
         "Objektzustand_num": "Avg_Condition"
     }, axis=1)
     avg_feature_data['Condition_Text'] = avg_feature_data['Avg_Condition'].apply(lambda x: reverse_condition_mapping.get(int(np.round(x)), 'Not Specified'))
@@ -987,7 +946,7 @@ def house_condition_table(data, col='City'):
     return fig
 
 
-@st.cache_data
+@dataset_cache
 def house_equipment_choropleth(data):
     equipment_mapping = {
         "luxus": 5,
@@ -1012,14 +971,13 @@ def house_equipment_choropleth(data):
         elif x >= 5:
             return "luxus"
 
-    data['Ausstattung_num'] = data['Ausstattung'].map(equipment_mapping)
-    avg_feature_data = data.groupby('bundesland')['Ausstattung_num'].mean().reset_index().rename({
+    data['Ausstattung_num'] = data['Ausstattung'].map(equipment_mapping).astype(float)
+    avg_feature_data = data.groupby('bundesland', observed=True)['Ausstattung_num'].mean().reset_index().rename({
         "Ausstattung_num": "Avg_Equipment"
     }, axis=1)
     avg_feature_data['Equipment'] = avg_feature_data['Avg_Equipment'].apply(inverse_map)
 
-    url = 'https://raw.githubusercontent.com/isellsoap/deutschlandGeoJSON/main/2_bundeslaender/2_hoch.geo.json'
-    geojson = requests.get(url).json()
+    geojson = load_states('medium')
 
     fig = px.choropleth_mapbox(
         avg_feature_data,
@@ -1057,7 +1015,7 @@ def house_equipment_choropleth(data):
     return fig
 
 
-@st.cache_data
+@dataset_cache
 def house_equipment_table(data, col='City'):
     main_col = 'Ort' if col == 'City' else 'Postleitzahl_2'
 
@@ -1074,10 +1032,10 @@ def house_equipment_table(data, col='City'):
     reverse_equipment_mapping = {v: k for k, v in equipment_mapping.items()}
 
     # Apply equipment mapping
-    data['Ausstattung_num'] = data['Ausstattung'].map(equipment_mapping)
+    data['Ausstattung_num'] = data['Ausstattung'].map(equipment_mapping).astype(float)
 
     # Group by chosen column and calculate average equipment score
-    avg_feature_data = data.groupby(main_col)['Ausstattung_num'].mean().reset_index().rename({
+    avg_feature_data = data.groupby(main_col, observed=True)['Ausstattung_num'].mean().reset_index().rename({
         "Ausstattung_num": "Avg_Condition"
     }, axis=1)
 
@@ -1126,7 +1084,7 @@ def house_equipment_table(data, col='City'):
 
 
 def lead_usage_distribution(data):
-    usage_data = data.groupby('Aktuelle Nutzung')['Id'].count().reset_index()
+    usage_data = lead_cube(data).groupby('Aktuelle Nutzung', observed=True)['Id'].sum().reset_index()
     usage_data = usage_data.sort_values(by='Id', ascending=False)
 
     usage_data = usage_data[usage_data['Id']>0]
@@ -1159,7 +1117,7 @@ def lead_usage_distribution(data):
 
 
 def lead_parking_distribution(data):
-    parking_data = data.groupby('Parkplatz')['Id'].count().reset_index()
+    parking_data = lead_cube(data).groupby('Parkplatz', observed=True)['Id'].sum().reset_index()
     parking_data = parking_data.sort_values(by='Id', ascending=False)
 
     parking_data = parking_data[parking_data['Id']>0]
@@ -1192,7 +1150,7 @@ def lead_parking_distribution(data):
 
 
 def lead_htype_distribution(data):
-    htype_data = data.groupby('Haustyp')['Id'].count().reset_index()
+    htype_data = lead_cube(data).groupby('Haustyp', observed=True)['Id'].sum().reset_index()
     htype_data = htype_data.sort_values(by='Id', ascending=True)
 
     htype_data = htype_data[htype_data['Id']>0]
@@ -1262,7 +1220,7 @@ def lead_feats_count_chart(df):
 
 
 def lead_equipment_distribution(data):
-    equipment_data = data.groupby('Ausstattung')['Id'].count().reset_index()
+    equipment_data = lead_cube(data).groupby('Ausstattung', observed=True)['Id'].sum().reset_index()
     equipment_data = equipment_data.sort_values(by='Id', ascending=False)
 
     equipment_data = equipment_data[equipment_data['Id'] > 0]
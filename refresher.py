@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import namedtuple
+
+Dataset = namedtuple('Dataset', ['data', 'fields', 'users', 'version'])
+
+
+class DatasetRefresher:
+    """
+    Refreshes a dataset on a background thread with stale-while-revalidate
+    semantics: readers always get the last good dataset immediately, while
+    `fetch(current)` builds the next one and swaps it in atomically. `fetch`
+    may return `current` itself when nothing changed.
+
+    Callbacks registered with `subscribe` run after a swap that changed the
+    dataset version, with the previous and the new dataset.
+    """
+
+    def __init__(self, fetch, interval=60):
+        self.fetch = fetch
+        self.interval = interval
+        self.last_refresh = None
+        self.last_duration = None
+        self.last_error = None
+        self._dataset = None
+        self._refresh_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    def start(self, initial=None):
+        """
+        Starts the refresh loop. `initial` (e.g. a snapshot) is served until
+        the first refresh finishes.
+        """
+        if initial is not None:
+            self._dataset = initial
+            self._ready.set()
+        self._thread = threading.Thread(target=self._run, name='dataset-refresher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+        return callback
+
+    def refresh(self):
+        """
+        Fetches a new dataset and swaps it in. On failure the previous dataset
+        stays in place and the error is kept in `last_error`, as is the error of
+        a failing listener.
+        """
+        with self._refresh_lock:
+            started = time.monotonic()
+            try:
+                dataset = self.fetch(self._dataset)
+            except Exception as err:
+                self.last_error = err
+                return self._dataset
+            previous, self._dataset = self._dataset, dataset
+            self.last_error = None
+            self.last_refresh = time.time()
+            self.last_duration = time.monotonic() - started
+            self._ready.set()
+            if previous is not None and previous.version != dataset.version:
+                for callback in self._listeners:
+                    # A failing listener must not stop the others or the refresh loop
+                    try:
+                        callback(previous, dataset)
+                    except Exception as err:
+                        self.last_error = err
+            return dataset
+
+    def get(self, timeout=None):
+        """
+        Returns the current dataset. Only blocks while there is none yet
+        (a cold start without a snapshot).
+        """
+        if not self._ready.wait(timeout):
+            raise TimeoutError("No dataset has been loaded yet.")
+        if self._dataset is None and self.last_error is not None:
+            raise self.last_error
+        return self._dataset
+
+    def stats(self):
+        """
+        Returns the refresh age and the duration of the last refresh, in seconds.
+        """
+        return {
+            'age': time.time() - self.last_refresh if self.last_refresh else None,
+            'last_duration': self.last_duration,
+            'last_error': self.last_error,
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as err:
+                self.last_error = err
+            if self._dataset is None and self.last_error is not None:
+                # Unblock readers so the error surfaces instead of a hang
+                self._ready.set()
+            self._stop.wait(self.interval)
@@ -0,0 +1,302 @@
+import unicodedata
+from bisect import bisect_left
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import per_version, shared_state
+from patched_index import PatchedIndex, lead_rows
+
+TEXT_COLUMNS = ['Nachricht', 'Objektinformationen', 'Immobilie und Lage', 'Modernisierungen',
+                'Schaeden/Maengel', 'Informationen zu besonderen Rechten']
+MISSING_TEXT = 'No Information'
+
+STOPWORDS = frozenset("""
+aber alle als also am an auch auf aus bei bin bis da das dass dem den der des die doch du ein eine einem
+einen einer eines er es fuer hat hatte ich ihr im in ist ja kann mit nach nicht noch nur ob oder sehr sich
+sie sind so um und uns vom von vor war was wie wir wird zu zum zur
+""".split())
+
+# Umlauts and ß are spelled out, other Latin accents dropped ('é' -> 'e'); built once instead of
+# decomposing every text at index time
+_TRANSLITERATION = str.maketrans({
+    **{chr(code): unicodedata.normalize('NFKD', chr(code)).encode('ascii', 'ignore').decode('ascii').lower()
+       for code in range(0xC0, 0x250)},
+    'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss', 'æ': 'ae', 'ø': 'o', 'œ': 'oe',
+})
+_TOKEN = r'[a-z0-9]+'
+
+# BM25 parameters, and the weight of a prefix match (e.g. 'dach' -> 'dachsanierung') relative to an exact one
+K1 = 1.2
+B = 0.75
+PREFIX_WEIGHT = 0.8
+# Minimum trigram similarity (Jaccard) of a fuzzy lead lookup match
+MIN_SIMILARITY = 0.3
+
+
+def normalize(texts):
+    """
+    Lower-cases a Series of strings and folds umlauts and ß ('Straße' -> 'strasse'),
+    so queries typed without them still match. Other accents are dropped.
+    """
+    return texts.str.lower().str.translate(_TRANSLITERATION)
+
+
+def tokenize(texts):
+    """
+    Splits a Series of strings into normalized tokens.
+
+    Returns:
+        Series: one token per entry, indexed like `texts`.
+    """
+    tokens = normalize(texts).str.findall(_TOKEN).explode().dropna()
+    return tokens[(tokens.str.len() > 1) & ~tokens.isin(STOPWORDS)]
+
+
+def _documents(data):
+    """
+    Tokens of the free-text columns per lead, as (Ids, tokens) arrays.
+    """
+    data = data.reset_index(drop=True)
+    parts = []
+    for col in TEXT_COLUMNS:
+        texts = data[col]
+        parts.append(texts[texts.notna() & (texts != MISSING_TEXT)].astype(str))
+    tokens = tokenize(pd.concat(parts)) if parts else pd.Series(dtype=object)
+    ids = data['Id'].reindex(tokens.index).to_numpy() if len(tokens) else np.array([], dtype=np.int64)
+    return ids, tokens.to_numpy()
+
+
+def _text_hashes(data):
+    hashes = pd.util.hash_pandas_object(data[TEXT_COLUMNS], index=False)
+    hashes.index = data['Id'].to_numpy()
+    return hashes[~hashes.index.duplicated(keep='last')]
+
+
+class SearchIndex(PatchedIndex):
+    """
+    Inverted index over the free-text fields of the leads, ranked with BM25.
+
+    In the bulk segment the terms are sorted, so all terms starting with a
+    query term form one contiguous slice of the postings. The delta segment
+    holds the postings of the changed leads in dicts. `sync` (see PatchedIndex)
+    finds the changed leads by hashing their text fields and only re-tokenizes
+    those.
+
+    Queries match leads containing every query term, either exactly or as a
+    prefix, which also finds German compounds by their first part.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._build(pd.DataFrame(columns=['Id'] + TEXT_COLUMNS))
+
+    def _state(self, data):
+        return _text_hashes(data)
+
+    def _build(self, data, state=None):
+        data = data.drop_duplicates(subset='Id', keep='last')
+        ids, tokens = _documents(data)
+        self._set_bulk(data['Id'].to_numpy())
+
+        docs = self._positions.get_indexer(ids)
+        tf = pd.DataFrame({'term': tokens, 'doc': docs}).groupby(['term', 'doc']).size()
+        term_codes, terms = pd.factorize(tf.index.get_level_values('term'))
+        self.terms = list(terms)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(term_codes, minlength=len(terms)))])
+        self.docs = tf.index.get_level_values('doc').to_numpy(dtype=np.int32)
+        self.tf = tf.to_numpy(dtype=np.float32)
+        self.doc_len = np.bincount(self.docs, weights=self.tf, minlength=len(self.ids)).astype(np.float32)
+
+        self._delta_docs = {}
+        self._delta_postings = {}
+        self._delta_terms = []
+
+    def _remove(self, ids):
+        self._mask(ids)
+        for lead_id in ids:
+            for term in self._delta_docs.pop(lead_id, {}):
+                postings = self._delta_postings[term]
+                del postings[lead_id]
+                if not postings:
+                    del self._delta_postings[term]
+
+    def _add(self, rows):
+        ids, tokens = _documents(rows)
+        counts = pd.DataFrame({'id': ids, 'term': tokens}).groupby(['id', 'term']).size()
+        for (lead_id, term), tf in counts.items():
+            self._delta_docs.setdefault(lead_id, {})[term] = tf
+            self._delta_postings.setdefault(term, {})[lead_id] = tf
+        for lead_id in rows['Id']:
+            self._delta_docs.setdefault(lead_id, {})
+
+    def _patch(self, data, state, changed, removed):
+        self._remove(list(changed.union(removed)))
+        self._add(data[data['Id'].isin(changed)].drop_duplicates(subset='Id', keep='last'))
+        self._delta_terms = sorted(self._delta_postings)
+
+    def search(self, query, limit=50):
+        """
+        Returns the Ids of the best matching leads with their scores, best first.
+        """
+        terms = list(dict.fromkeys(tokenize(pd.Series([query], dtype=object))))
+        if not terms:
+            return []
+
+        with self._lock:
+            n_docs = int(self.alive.sum()) + len(self._delta_docs)
+            delta_len = {lead_id: sum(doc.values()) for lead_id, doc in self._delta_docs.items()}
+            avg_len = (self.doc_len[self.alive].sum() + sum(delta_len.values())) / max(n_docs, 1) or 1.0
+
+            total = np.zeros(len(self.ids))
+            matched = np.zeros(len(self.ids), dtype=int)
+            delta_total, delta_matched = {}, {}
+            for term in terms:
+                lo = bisect_left(self.terms, term)
+                hi = bisect_left(self.terms, term + chr(0x10ffff))
+                score = np.zeros(len(self.ids))
+                if hi > lo:
+                    doc_freq = np.diff(self.offsets[lo:hi + 1])
+                    weight = np.full(hi - lo, PREFIX_WEIGHT)
+                    weight[0] = 1.0 if self.terms[lo] == term else PREFIX_WEIGHT
+                    term_score = weight * np.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+                    docs = self.docs[self.offsets[lo]:self.offsets[hi]]
+                    tf = self.tf[self.offsets[lo]:self.offsets[hi]]
+                    norm = K1 * (1 - B + B * self.doc_len[docs] / avg_len)
+                    np.maximum.at(score, docs, np.repeat(term_score, doc_freq) * tf * (K1 + 1) / (tf + norm))
+                    score[~self.alive] = 0
+                total += score
+                matched += score > 0
+
+                term_scores = {}
+                for delta_term in self._delta_terms[bisect_left(self._delta_terms, term):
+                                                    bisect_left(self._delta_terms, term + chr(0x10ffff))]:
+                    postings = self._delta_postings[delta_term]
+                    weight = 1.0 if delta_term == term else PREFIX_WEIGHT
+                    idf = np.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for lead_id, tf in postings.items():
+                        norm = K1 * (1 - B + B * delta_len[lead_id] / avg_len)
+                        value = float(weight * idf * tf * (K1 + 1) / (tf + norm))
+                        term_scores[lead_id] = max(term_scores.get(lead_id, 0), value)
+                for lead_id, value in term_scores.items():
+                    delta_total[lead_id] = delta_total.get(lead_id, 0) + value
+                    delta_matched[lead_id] = delta_matched.get(lead_id, 0) + 1
+
+            hits = np.flatnonzero(matched == len(terms))
+            if len(hits) > limit:
+                hits = hits[np.argpartition(-total[hits], limit)[:limit]]
+            results = list(zip(self.ids[hits].tolist(), total[hits].tolist()))
+            results += [(lead_id, delta_total[lead_id]) for lead_id, count in delta_matched.items()
+                        if count == len(terms)]
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results[:limit]
+
+
+def _phone_digits(phones):
+    """
+    Phone numbers reduced to their digits without country code or leading zeros,
+    so '+49 151 234', '0151/234' and 151234 (a number read from the sheet) agree.
+    """
+    digits = phones.str.replace(r'\D', '', regex=True)
+    return digits.str.replace(r'^(00)?49', '', regex=True).str.lstrip('0')
+
+
+def _trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class LeadLookup:
+    """
+    Typeahead lookup of leads by first name, last name, full name, email,
+    phone number and Id.
+
+    All normalized keys are kept in one sorted list, so the keys starting with
+    what was typed form one contiguous range found by bisection, and only the
+    first `limit` leads of that range are looked at. When the prefix finds too
+    few leads (e.g. a typo), names and emails are matched by trigram similarity
+    through a trigram -> key index.
+    """
+
+    def __init__(self, data):
+        data = data.reset_index(drop=True)
+        text_keys = [normalize(data['Vorname'].astype(str)),
+                     normalize(data['Nachname'].astype(str)),
+                     normalize(data['Vorname'].astype(str) + ' ' + data['Nachname'].astype(str)),
+                     normalize(data['Email'].astype(str))]
+        digit_keys = [_phone_digits(data['Telefon'].astype(str)), data['Id'].astype(str)]
+        keys = pd.concat(text_keys + digit_keys)
+        keys = keys[(keys.str.len() > 0) & (keys != 'nan')]
+        keys_array = keys.to_numpy(dtype=str)
+        order = np.argsort(keys_array, kind='stable')
+        self.keys = keys_array[order]
+        self.rows = keys.index.to_numpy()[order]
+
+        # Trigrams of the distinct name and email keys; the rows of every key in CSR form
+        fuzzy = pd.concat(text_keys)
+        fuzzy = fuzzy[(fuzzy.str.len() > 0) & (fuzzy != 'nan')]
+        self.fuzzy_keys, fuzzy_codes = np.unique(fuzzy.to_numpy(dtype=str), return_inverse=True)
+        order = np.argsort(fuzzy_codes, kind='stable')
+        self.fuzzy_rows = fuzzy.index.to_numpy()[order]
+        self.fuzzy_offsets = np.concatenate([[0], np.cumsum(np.bincount(fuzzy_codes, minlength=len(self.fuzzy_keys)))])
+
+        grams = [(gram, code) for code, key in enumerate(self.fuzzy_keys.tolist()) for gram in _trigrams(key)]
+        pairs = pd.DataFrame(grams, columns=['gram', 'key'])
+        gram_codes, grams = pd.factorize(pairs['gram'])
+        order = np.argsort(gram_codes, kind='stable')
+        self.grams = pd.Index(grams)
+        self.gram_offsets = np.concatenate([[0], np.cumsum(np.bincount(gram_codes, minlength=len(grams)))])
+        self.gram_keys = pairs['key'].to_numpy(dtype=np.int32)[order]
+        self.gram_counts = np.bincount(self.gram_keys, minlength=len(self.fuzzy_keys))
+
+    def search(self, query, limit=10):
+        """
+        Returns the row positions of up to `limit` leads matching `query`,
+        prefix matches first, then fuzzy matches by similarity.
+        """
+        query = query.strip()
+        if not query:
+            return []
+        prefixes = [normalize(pd.Series([query])).iloc[0]]
+        if not any(char.isalpha() for char in query):
+            prefixes += [prefix for prefix in _phone_digits(pd.Series([query])) if prefix not in prefixes]
+
+        found = {}
+        for prefix in prefixes:
+            lo, hi = np.searchsorted(self.keys, [prefix, prefix + chr(0x10ffff)])
+            for row in self.rows[lo:hi]:
+                found.setdefault(int(row), None)
+                if len(found) >= limit:
+                    return list(found)
+
+        grams = _trigrams(prefixes[0])
+        codes = self.grams.get_indexer(list(grams))
+        codes = codes[codes >= 0]
+        if len(codes):
+            keys = np.concatenate([self.gram_keys[self.gram_offsets[c]:self.gram_offsets[c + 1]] for c in codes])
+            shared = np.bincount(keys, minlength=len(self.fuzzy_keys))
+            similarity = shared / (len(grams) + self.gram_counts - shared)
+            candidates = np.flatnonzero(similarity >= MIN_SIMILARITY)
+            for key in candidates[np.argsort(-similarity[candidates], kind='stable')]:
+                for row in self.fuzzy_rows[self.fuzzy_offsets[key]:self.fuzzy_offsets[key + 1]]:
+                    found.setdefault(int(row), None)
+                    if len(found) >= limit:
+                        return list(found)
+        return list(found)
+
+
+@per_version
+def get_lead_lookup(data):
+    """
+    Returns the LeadLookup of `data`, built once per dataset version.
+    """
+    return LeadLookup(data)
+
+
+def search_leads(data, query, limit=50):
+    """
+    Returns the leads of `data` whose text fields match `query`, best match first.
+    """
+    index = shared_state(SearchIndex)
+    index.sync(data)
+    return lead_rows(data, [lead_id for lead_id, _ in index.search(query, limit=limit)])
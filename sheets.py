@@ -0,0 +1,354 @@
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from gspread.exceptions import APIError
+from gspread.utils import rowcol_to_a1
+from gspread_dataframe import get_as_dataframe
+
+
+RETRY_STATUS_CODES = {429, 500, 502, 503}
+# A write that failed with a server error may still have been applied, only a
+# rate-limited (429) one is known to have been rejected and is safe to repeat
+WRITE_RETRY_STATUS_CODES = {429}
+# Attempts at an upsert whose target rows moved between locating and writing
+WRITE_ATTEMPTS = 3
+
+
+class SheetChangedError(Exception):
+    """
+    The rows a write targets moved or changed while it was being prepared, so
+    it was not applied.
+    """
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical calls: while a call for a key is in flight,
+    other callers with the same key wait for it and share its result (or error)
+    instead of issuing their own request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+        except Exception as err:
+            call['error'] = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+def with_backoff(fn, retries=5, base_delay=1.0, max_delay=32.0, status_codes=RETRY_STATUS_CODES):
+    """
+    Calls `fn`, retrying with exponential backoff and jitter while the Sheets
+    API answers with one of `status_codes`: by default a rate-limit (429) or a
+    transient server error. Writes that are not idempotent pass
+    WRITE_RETRY_STATUS_CODES.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except APIError as err:
+            status = getattr(err.response, 'status_code', None)
+            if status not in status_codes or attempt == retries:
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+
+# Shared by every session of the process
+_single_flight = SingleFlight()
+
+
+def normalize_ids(ids):
+    """
+    Converts Id values as read from a sheet ('12', 12, 12.0, '') to floats, NaN for blanks.
+    """
+    return pd.to_numeric(pd.Series(ids, dtype=object), errors='coerce').to_numpy(dtype=float)
+
+
+def merge_rows(frame, rows, key='Id'):
+    """
+    Merges `rows` into `frame` by key: matching rows are replaced in place and
+    new ones are appended, so the row order keeps mirroring the sheet. Columns
+    missing from `rows` keep their current values.
+    """
+    rows = rows.drop_duplicates(subset=key, keep='last').reset_index(drop=True)
+    positions = pd.Series(np.arange(len(frame)), index=normalize_ids(frame[key]))
+    positions = positions[~positions.index.duplicated(keep='last')]
+    row_positions = positions.reindex(normalize_ids(rows[key])).to_numpy()
+    is_new = np.isnan(row_positions)
+    row_positions[is_new] = len(frame) + np.arange(is_new.sum())
+
+    missing = frame.columns.difference(rows.columns)
+    rows = rows.reindex(columns=frame.columns)
+    if len(missing) and not is_new.all():
+        rows.loc[~is_new, missing] = frame.iloc[row_positions[~is_new].astype(int)][missing].to_numpy()
+
+    replaced = np.zeros(len(frame), dtype=bool)
+    replaced[row_positions[~is_new].astype(int)] = True
+    kept = frame[~replaced].assign(_position=np.flatnonzero(~replaced))
+    merged = pd.concat([kept, rows.assign(_position=row_positions)])
+    return merged.sort_values('_position', kind='stable').drop(columns='_position').reset_index(drop=True)
+
+
+def _cell(value):
+    if isinstance(value, pd.Timestamp):
+        return value.strftime("%Y-%m-%d %H:%M:%S") if not pd.isna(value) else ''
+    if value is None or (np.ndim(value) == 0 and pd.isna(value)):
+        return ''
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class SheetsBackend:
+    """
+    Worksheet access on top of the app's GSheetsConnection.
+
+    Unlike `conn.read`, nothing here goes through Streamlit's cache, so the
+    methods are safe to call from the sync layer and from background threads.
+    Identical concurrent reads are coalesced into one request and rate-limited
+    calls are retried with exponential backoff. It mirrors the `read`/`update`
+    calls of GSheetsConnection, so it can be passed wherever the app expects `conn`.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._spreadsheet = None
+        self._worksheets = {}
+        self._lock = threading.Lock()
+
+    def _worksheet(self, worksheet):
+        """
+        The Worksheet handle of `worksheet`. The spreadsheet is opened once and
+        every handle is kept, so later calls make no metadata requests.
+        """
+        with self._lock:
+            handle = self._worksheets.get(worksheet)
+            if handle is None:
+                if self._spreadsheet is None:
+                    self._spreadsheet = with_backoff(lambda: self.conn.client._open_spreadsheet())
+                handle = with_backoff(lambda: self._spreadsheet.worksheet(worksheet))
+                self._worksheets[worksheet] = handle
+            return handle
+
+    def _read(self, key, fn):
+        return _single_flight.do(key, lambda: with_backoff(fn))
+
+    def read(self, worksheet):
+        """
+        Reads the whole worksheet into a DataFrame.
+        """
+        data = self._read(('read', worksheet), lambda: get_as_dataframe(self._worksheet(worksheet),
+                                                                        evaluate_formulas=True))
+        # Waiters share the leader's frame, so every caller gets its own copy
+        return data.copy()
+
+    def modified_at(self, worksheet):
+        """
+        Returns the last modification stamp of the spreadsheet.
+        """
+        return self._read(('modified_at', worksheet),
+                          lambda: self._worksheet(worksheet).spreadsheet.get_lastUpdateTime())
+
+    def update(self, data, worksheet):
+        """
+        Replaces the worksheet contents with `data`.
+        """
+        return with_backoff(lambda: self.conn.update(data=data, worksheet=worksheet))
+
+    def _key_column(self, ws, header, key):
+        """
+        The keys of the data rows of `ws`, as normalized by `normalize_ids`.
+        """
+        return normalize_ids(with_backoff(lambda: ws.col_values(header.index(key) + 1))[1:])
+
+    def _rows_unchanged(self, ws, header, key, row_numbers, expected_ids):
+        """
+        Re-reads the key column and tells whether the sheet rows `row_numbers`
+        (1-based, the header being row 1) still hold the keys `expected_ids`.
+        """
+        sheet_ids = self._key_column(ws, header, key)
+        positions = np.asarray(row_numbers, dtype=int) - 2
+        if len(positions) and positions.max() >= len(sheet_ids):
+            return False
+        return bool((sheet_ids[positions] == np.asarray(expected_ids, dtype=float)).all())
+
+    def upsert_rows(self, worksheet, rows, key='Id'):
+        """
+        Writes rows by key without touching the rest of the sheet: existing rows
+        are overwritten in place (only the columns present in `rows`) and new
+        ones are appended. The whole batch costs two lookups of the key column,
+        one batch_update and one append call, whatever the sheet size.
+
+        The key column is read again right before the batch_update, and the rows
+        are located anew when a target row no longer holds its key, i.e. when
+        rows were inserted or deleted in between. After WRITE_ATTEMPTS tries
+        SheetChangedError is raised and nothing is written. The writes are only
+        repeated after a rate-limit, as a server error may hide an applied write.
+        """
+        ws = self._worksheet(worksheet)
+        header = with_backoff(lambda: ws.row_values(1))
+
+        # Contiguous runs of header columns that are present in `rows`
+        present = [col in rows.columns for col in header]
+        runs = []
+        for idx, is_present in enumerate(present):
+            if is_present and (not runs or runs[-1][1] != idx - 1):
+                runs.append([idx, idx])
+            elif is_present:
+                runs[-1][1] = idx
+
+        rows = rows.drop_duplicates(subset=key, keep='last')
+        records = list(zip(normalize_ids(rows[key]), rows.to_dict('records')))
+        for _ in range(WRITE_ATTEMPTS):
+            sheet_ids = self._key_column(ws, header, key)
+            row_numbers = {sheet_id: number for number, sheet_id in enumerate(sheet_ids, start=2)
+                           if not np.isnan(sheet_id)}
+
+            updates, appends, targets = [], [], {}
+            for row_id, record in records:
+                values = [_cell(record.get(col)) for col in header]
+                number = row_numbers.get(row_id)
+                if number is None:
+                    appends.append(values)
+                    continue
+                targets[row_id] = number
+                for start, end in runs:
+                    updates.append({
+                        'range': f"{rowcol_to_a1(number, start + 1)}:{rowcol_to_a1(number, end + 1)}",
+                        'values': [values[start:end + 1]],
+                    })
+            if not targets or self._rows_unchanged(ws, header, key, list(targets.values()), list(targets)):
+                break
+        else:
+            raise SheetChangedError(f"The rows of '{worksheet}' kept moving, nothing was written.")
+
+        if updates:
+            with_backoff(lambda: ws.batch_update(updates, value_input_option='USER_ENTERED'),
+                         status_codes=WRITE_RETRY_STATUS_CODES)
+        if appends:
+            with_backoff(lambda: ws.append_rows(appends, value_input_option='USER_ENTERED', table_range='A1'),
+                         status_codes=WRITE_RETRY_STATUS_CODES)
+
+    def delete_rows(self, worksheet, ids, key='Id'):
+        """
+        Deletes the rows with the given keys in a single batchUpdate request.
+        Only the key column is read to locate them.
+
+        The deletes are positional, so the key column is read again right
+        before the request and SheetChangedError is raised, with nothing
+        deleted, when a located row no longer holds its key. The request is
+        never repeated: a failed attempt may have been applied, and a repeat
+        would delete the rows that moved up into those positions.
+
+        Returns:
+            int: the number of deleted rows.
+        """
+        ws = self._worksheet(worksheet)
+        header = with_backoff(lambda: ws.row_values(1))
+        sheet_ids = self._key_column(ws, header, key)
+        row_indices = np.flatnonzero(np.isin(sheet_ids, normalize_ids(ids))) + 1  # 0-based, after header
+        if not len(row_indices):
+            return 0
+
+        # One deleteDimension per contiguous block, bottom-up so earlier indices stay valid
+        blocks = np.split(row_indices, np.flatnonzero(np.diff(row_indices) != 1) + 1)
+        requests = [{
+            'deleteDimension': {
+                'range': {'sheetId': ws.id, 'dimension': 'ROWS',
+                          'startIndex': int(block[0]), 'endIndex': int(block[-1]) + 1}
+            }
+        } for block in reversed(blocks)]
+        if not self._rows_unchanged(ws, header, key, row_indices + 1, sheet_ids[row_indices - 1]):
+            raise SheetChangedError(f"The rows of '{worksheet}' moved while deleting, nothing was deleted.")
+        ws.spreadsheet.batch_update({'requests': requests})
+        return len(row_indices)
+
+
+class LocalSheetBackend:
+    """
+    Local stand-in for the Google Sheet: every worksheet is a CSV file
+    `<directory>/<worksheet>.csv`. It also mirrors the `read`/`update` calls of
+    GSheetsConnection, so it can be passed wherever the app expects `conn`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, worksheet):
+        return os.path.join(self.directory, f"{worksheet}.csv")
+
+    def read(self, worksheet):
+        return pd.read_csv(self._path(worksheet)).dropna(how='all')
+
+    def _content(self, worksheet):
+        with open(self._path(worksheet), 'rb') as f:
+            return f.read()
+
+    def content_stamp(self, worksheet):
+        """
+        Size and digest of the CSV file, which `read_appended` later checks the
+        file against.
+        """
+        content = self._content(worksheet)
+        return len(content), hashlib.sha1(content).hexdigest()
+
+    def read_appended(self, worksheet, stamp):
+        """
+        The rows appended to the file since it had the content stamp `stamp`,
+        with the new stamp. Returns None unless the file still starts with
+        exactly that content, i.e. unless existing rows are provably unchanged.
+        """
+        content = self._content(worksheet)
+        size, digest = stamp
+        # A last line without newline could have been continued by the append
+        if not size or len(content) < size or content[size - 1:size] != b'\n':
+            return None
+        if hashlib.sha1(content[:size]).hexdigest() != digest:
+            return None
+        header = content[:content.index(b'\n') + 1]
+        rows = pd.read_csv(io.BytesIO(header + content[size:])).dropna(how='all')
+        return rows, (len(content), hashlib.sha1(content).hexdigest())
+
+    def modified_at(self, worksheet):
+        return os.path.getmtime(self._path(worksheet))
+
+    def update(self, data, worksheet):
+        data.to_csv(self._path(worksheet), index=False)
+
+    def upsert_rows(self, worksheet, rows, key='Id'):
+        self.update(merge_rows(self.read(worksheet), rows, key=key), worksheet)
+
+    def delete_rows(self, worksheet, ids, key='Id'):
+        data = self.read(worksheet)
+        matches = np.isin(normalize_ids(data[key]), normalize_ids(ids))
+        if matches.any():
+            self.update(data[~matches], worksheet)
+        return int(matches.sum())
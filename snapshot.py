@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SNAPSHOT_META_KEY = b'leads_snapshot'
+
+
+def frame_version(df, salt=None):
+    """
+    Returns a short content hash of a DataFrame, used as its version stamp.
+    `salt` (e.g. the stamp of other data the frame is processed with) is
+    hashed in as well.
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    digest = hashlib.sha1(row_hashes.tobytes())
+    digest.update('|'.join(map(str, df.columns)).encode('utf-8'))
+    if salt is not None:
+        digest.update(str(salt).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def _arrow_safe(df):
+    """
+    Casts object columns that mix strings and numbers to strings, which Arrow
+    requires. Categoricals with mixed categories are stored the same way.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            values = df[col].cat.categories.to_series()
+        elif df[col].dtype == object:
+            values = df[col].dropna()
+        else:
+            continue
+        if values.map(type).nunique() > 1:
+            df[col] = df[col].astype(object).where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def write_snapshot(df, version, path, fields=None, processing=None, gazetteer=None):
+    """
+    Writes the processed leads frame to a Parquet file together with its
+    version stamp, the layout version of the processing that produced it and
+    the stamp of the gazetteer its coordinates come from.
+    The file is replaced atomically so readers never see a partially written
+    snapshot.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    table = pa.Table.from_pandas(_arrow_safe(df))
+    meta = {
+        'version': version,
+        'fields': list(fields) if fields is not None else list(df.columns),
+        'processing': processing,
+        'gazetteer': gazetteer,
+        'written_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           SNAPSHOT_META_KEY: json.dumps(meta).encode('utf-8')})
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot_meta(path):
+    """
+    Reads only the metadata of a snapshot, without loading the frame.
+    """
+    try:
+        return json.loads(pq.read_schema(path).metadata[SNAPSHOT_META_KEY])
+    except (pa.ArrowException, OSError, KeyError, TypeError, ValueError):
+        return None
+
+
+def read_snapshot(path):
+    """
+    Reads a snapshot written by `write_snapshot`.
+
+    Returns:
+        tuple: (DataFrame, metadata dict), or (None, None) if there is no usable snapshot.
+    """
+    if not os.path.exists(path):
+        return None, None
+    try:
+        table = pq.read_table(path)
+        meta = json.loads(table.schema.metadata[SNAPSHOT_META_KEY])
+    except (pa.ArrowException, OSError, KeyError, ValueError):
+        return None, None
+    return table.to_pandas(), meta
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+from dataset_cache import shared_state
+from patched_index import PatchedIndex, lead_rows
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+# Edge of a grid cell, and the latitude at which the longitude is scaled to km (the middle of Germany)
+CELL_KM = 10.0
+REFERENCE_LATITUDE = 51.0
+_X_SCALE = KM_PER_DEGREE * np.cos(np.radians(REFERENCE_LATITUDE))
+GRID_COLUMNS = int(np.ceil(360 * _X_SCALE / CELL_KM)) + 1
+
+
+def grid_cells(lat, lon):
+    """
+    Grid row and column of each point. Columns are scaled at REFERENCE_LATITUDE,
+    so cells are CELL_KM wide there and narrower towards the poles.
+    """
+    rows = np.floor((np.asarray(lat, dtype=float) + 90) * KM_PER_DEGREE / CELL_KM).astype(np.int64)
+    cols = np.floor((np.asarray(lon, dtype=float) + 180) * _X_SCALE / CELL_KM).astype(np.int64)
+    return rows, cols
+
+
+def haversine_km(lat, lon, lats, lons):
+    """
+    Great-circle distance in km from the point (`lat`, `lon`) to each of the points (`lats`, `lons`).
+    """
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def _coordinates(data):
+    """
+    Coordinates of the located leads of `data`, indexed by Id.
+    """
+    coordinates = data.loc[data['lat'].notna() & data['lon'].notna(), ['Id', 'lat', 'lon']]
+    coordinates = coordinates.drop_duplicates(subset='Id', keep='last').set_index('Id')
+    return coordinates.astype(float)
+
+
+class SpatialIndex(PatchedIndex):
+    """
+    Grid index over the lead coordinates for radius and k-nearest queries.
+
+    In the bulk segment the points are sorted by their grid cell key
+    (row * GRID_COLUMNS + column), so the cells of one grid row that a query
+    circle covers form one contiguous slice, found by bisection. The delta
+    segment is a small frame of coordinates that is scanned in full. `sync`
+    (see PatchedIndex) compares the coordinates per Id to find the added,
+    moved and dropped leads.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._build(None, pd.DataFrame({'lat': [], 'lon': []}, index=pd.Index([], name='Id')))
+
+    def _state(self, data):
+        return _coordinates(data)
+
+    def _build(self, data, coordinates):
+        rows, cols = grid_cells(coordinates['lat'], coordinates['lon'])
+        keys = rows * GRID_COLUMNS + cols
+        order = np.argsort(keys, kind='stable')
+        self._set_bulk(coordinates.index.to_numpy()[order])
+        self.keys = keys[order]
+        self.lat = coordinates['lat'].to_numpy(dtype=float)[order]
+        self.lon = coordinates['lon'].to_numpy(dtype=float)[order]
+        self._delta = coordinates.iloc[:0]
+
+    def _patch(self, data, coordinates, changed, removed):
+        stale = changed.union(removed)
+        self._mask(stale)
+        delta = self._delta[~self._delta.index.isin(stale)]
+        self._delta = pd.concat([delta, coordinates.loc[changed]]) if len(changed) else delta
+
+    def _candidates(self, lat, lon, radius_km):
+        """
+        Positions of the bulk points in the grid cells the circle around (`lat`, `lon`) touches.
+        """
+        lat_span = radius_km / KM_PER_DEGREE
+        # The circle is widest (in degrees of longitude) at its latitude nearest the pole
+        far_latitude = min(abs(lat) + lat_span, 90.0)
+        if far_latitude >= 89.9:
+            lon_span = 180.0
+        else:
+            lon_span = min(radius_km / (KM_PER_DEGREE * np.cos(np.radians(far_latitude))), 180.0)
+        (row_lo, row_hi), (col_lo, col_hi) = grid_cells([lat - lat_span, lat + lat_span],
+                                                        [lon - lon_span, lon + lon_span])
+        rows = np.arange(row_lo, row_hi + 1)
+        col_lo, col_hi = max(col_lo, 0), min(col_hi, GRID_COLUMNS - 1)
+        starts = np.searchsorted(self.keys, rows * GRID_COLUMNS + col_lo)
+        ends = np.searchsorted(self.keys, rows * GRID_COLUMNS + col_hi, side='right')
+        # Concatenates the ranges starts[i]:ends[i] without a loop over the rows
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(lengths.sum())
+        return positions[self.alive[positions]]
+
+    def _within(self, lat, lon, radius_km):
+        positions = self._candidates(lat, lon, radius_km)
+        ids = np.concatenate([self.ids[positions], self._delta.index.to_numpy()])
+        distances = np.concatenate([haversine_km(lat, lon, self.lat[positions], self.lon[positions]),
+                                    haversine_km(lat, lon, self._delta['lat'].to_numpy(),
+                                                 self._delta['lon'].to_numpy())])
+        inside = distances <= radius_km
+        ids, distances = ids[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return ids[order], distances[order]
+
+    def within_radius(self, lat, lon, radius_km, limit=None):
+        """
+        Ids of the leads within `radius_km` of (`lat`, `lon`) and their distances
+        in km, nearest first, at most `limit` of them.
+        """
+        with self._lock:
+            ids, distances = self._within(lat, lon, radius_km)
+        return ids[:limit], distances[:limit]
+
+    def nearest(self, lat, lon, k=10):
+        """
+        Ids of the `k` leads nearest to (`lat`, `lon`) and their distances in km,
+        nearest first.
+
+        The search circle starts at one grid cell and grows until it holds `k`
+        leads. Every lead within the circle is found, so its `k` nearest are
+        the nearest overall.
+        """
+        with self._lock:
+            n_leads = int(self.alive.sum()) + len(self._delta)
+            radius = CELL_KM
+            ids, distances = self._within(lat, lon, radius)
+            while len(ids) < min(k, n_leads) and radius < np.pi * EARTH_RADIUS_KM:
+                radius *= 4
+                ids, distances = self._within(lat, lon, radius)
+        return ids[:k], distances[:k]
+
+
+def nearby_leads(data, row, radius_km, limit=20, k=5):
+    """
+    The leads of `data` within `radius_km` of the lead `row` (at most `limit`),
+    or its `k` nearest leads when there are none, with their distance in
+    'Distance (km)', nearest first. The lead itself is left out.
+    """
+    if pd.isnull(row['lat']) or pd.isnull(row['lon']):
+        return data.iloc[:0].assign(**{'Distance (km)': []})
+    index = shared_state(SpatialIndex)
+    index.sync(data)
+    ids, distances = index.within_radius(row['lat'], row['lon'], radius_km, limit=limit + 1)
+    if (ids != row['Id']).sum() == 0:
+        ids, distances = index.nearest(row['lat'], row['lon'], k=k + 1)
+    keep = ids != row['Id']
+    ids, distances = pd.Index(ids[keep][:limit]), distances[keep][:limit]
+
+    rows = lead_rows(data, ids)
+    return rows.assign(**{'Distance (km)': distances[ids.get_indexer(rows['Id'])].round(1)})
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The app modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_processing import synthetic_leads  # noqa: E402
+
+
+@pytest.fixture
+def raw_leads():
+    """
+    A raw leads sheet of 400 rows with a few leads without postcode, so the
+    postcode column is read back as floats, as from a real sheet.
+    """
+    data = synthetic_leads(400, seed=7)
+    data['Postleitzahl'] = data['Postleitzahl'].astype(float)
+    data.loc[np.arange(0, 400, 37), 'Postleitzahl'] = np.nan
+    return data
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from data_processing import process_data
+from filter_index import FILTER_COLUMNS, FilterIndex
+
+
+@pytest.fixture
+def leads(raw_leads):
+    return process_data(raw_leads)
+
+
+def isin_rows(data, selection):
+    """
+    Row positions of the boolean isin mask the filters used before the index.
+    """
+    mask = np.ones(len(data), dtype=bool)
+    for col, values in selection.items():
+        if len(values):
+            mask &= data[col].isin(values).to_numpy()
+    return np.flatnonzero(mask)
+
+
+def some_values(data, col, n, rng):
+    values = data[col].unique()
+    return list(rng.choice(values, size=min(n, len(values)), replace=False))
+
+
+@pytest.mark.parametrize('selection', [
+    {},
+    {'bundesland': ['Bayern']},
+    {'bundesland': ['Bayern', 'Berlin'], 'Objekttyp': ['Haus']},
+    {'property_area_range': ['Up to 800 sqm', '800-1100 sqm', '1100-1300 sqm', '1300-1500 sqm',
+                             '1500-2000 sqm', '2000-3000 sqm', 'Above 3000 sqm']},
+    {'bundesland': ['Atlantis']},
+    {'bundesland': ['Bayern'], 'Ort': ['Atlantis']},
+    {'Ort': [], 'Objekttyp': []},
+])
+def test_select_matches_isin(leads, selection):
+    index = FilterIndex(leads)
+    np.testing.assert_array_equal(index.select(selection), isin_rows(leads, selection))
+
+
+def test_random_selections_match_isin(leads):
+    index = FilterIndex(leads)
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        selection = {col: some_values(leads, col, rng.integers(1, 6), rng)
+                     for col in rng.choice(FILTER_COLUMNS, size=rng.integers(1, 4), replace=False)}
+        np.testing.assert_array_equal(index.select(selection), isin_rows(leads, selection))
+
+
+def test_facet_counts_leave_out_their_own_dimension(leads):
+    index = FilterIndex(leads)
+    selection = {'bundesland': ['Bayern', 'Berlin'], 'Objekttyp': ['Haus', 'Wohnung']}
+    rows, counts = index.facet_counts(selection)
+    np.testing.assert_array_equal(rows, isin_rows(leads, selection))
+    for col in FILTER_COLUMNS:
+        others = {c: v for c, v in selection.items() if c != col}
+        expected = leads[col].iloc[isin_rows(leads, others)].value_counts()
+        got = dict(zip(index.values[col], counts[col]))
+        assert {value: n for value, n in got.items() if n} == expected[expected > 0].to_dict()
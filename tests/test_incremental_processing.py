@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_processing import PROCESSING_VERSION, LeadsProcessor, make_read_only, process_data
+from data_sync import LeadsSync
+from sheets import LocalSheetBackend
+from snapshot import read_snapshot, write_snapshot
+
+
+class Sheet:
+    """
+    The leads worksheet as a local CSV file, with a modification time that
+    moves forward on every write.
+    """
+
+    def __init__(self, directory, raw):
+        self.path = os.path.join(directory, 'leads.csv')
+        self.backend = LocalSheetBackend(directory)
+        self._mtime = 1_700_000_000
+        self.write(raw)
+
+    def _touch(self):
+        self._mtime += 10
+        os.utime(self.path, (self._mtime, self._mtime))
+
+    def write(self, raw):
+        raw.to_csv(self.path, index=False)
+        self._touch()
+
+    def append(self, rows):
+        with open(self.path, 'a') as f:
+            rows.to_csv(f, header=False, index=False)
+        self._touch()
+
+    def read(self):
+        return self.backend.read('leads')
+
+
+@pytest.fixture
+def sheet(tmp_path, raw_leads):
+    return Sheet(str(tmp_path), raw_leads)
+
+
+@pytest.fixture
+def sync(sheet):
+    return LeadsSync(sheet.backend, worksheet='leads')
+
+
+def assert_matches_full_run(processor, sync, delta):
+    processed = make_read_only(processor.process(sync.frame, delta))
+    pd.testing.assert_frame_equal(processed, process_data(sync.frame.copy()), check_exact=False, rtol=1e-9)
+    return processed
+
+
+def new_leads(raw, n, offset=100_000):
+    rows = raw.tail(n).copy()
+    rows['Id'] = rows['Id'] + offset
+    return rows
+
+
+def test_appended_leads(sheet, sync):
+    processor = LeadsProcessor()
+    assert_matches_full_run(processor, sync, sync.sync())
+
+    rows = new_leads(sheet.read(), 15)
+    rows.iloc[0, rows.columns.get_loc('Grundstueckflaeche')] = 99_999
+    rows.iloc[1, rows.columns.get_loc('Ort')] = 'Neustadt'
+    sheet.append(rows)
+    delta = sync.sync()
+    assert len(delta.changed) == 15
+    assert_matches_full_run(processor, sync, delta)
+
+
+def test_edited_and_removed_leads(sheet, sync):
+    processor = LeadsProcessor()
+    assert_matches_full_run(processor, sync, sync.sync())
+
+    raw = sheet.read()
+    raw.loc[5, 'Grundstueckflaeche'] = np.nan
+    raw.loc[7, 'Baujahr'] = 99
+    raw.loc[9, 'Objekttyp'] = 'Burg'
+    raw.loc[11, 'Grundstueckflaeche'] = 123_456
+    sheet.write(raw.drop(index=[3, 4]))
+    delta = sync.sync()
+    assert len(delta.removed_ids) == 2
+    processed = assert_matches_full_run(processor, sync, delta)
+    assert 'Burg' in set(processed['Objekttyp'])
+
+
+def test_upserts_and_deletes(sheet, sync):
+    processor = LeadsProcessor()
+    assert_matches_full_run(processor, sync, sync.sync())
+
+    edited = sync.frame.iloc[[20]].copy()
+    edited['Grundstueckflaeche'] = np.nan
+    edited['Ort'] = 'Dorf'
+    sync.upsert(pd.concat([edited, new_leads(sync.frame, 1)]))
+    sync.delete(sync.frame['Id'].iloc[[30, 31]].tolist())
+    assert_matches_full_run(processor, sync, sync.sync())
+    assert_matches_full_run(processor, sync, sync.sync())
+
+
+def test_missed_delta_processes_the_whole_sheet(sheet, sync):
+    processor = LeadsProcessor()
+    assert_matches_full_run(processor, sync, sync.sync())
+
+    sheet.append(new_leads(sheet.read(), 5))
+    sync.sync()
+    raw = sheet.read()
+    raw.loc[40, 'Grundstueckflaeche'] = 1.0
+    sheet.write(raw)
+    assert_matches_full_run(processor, sync, sync.sync())
+
+
+def test_cold_start_from_snapshot(tmp_path, sheet, sync):
+    delta = sync.sync()
+    processed = make_read_only(process_data(sync.frame.copy()))
+    path = str(tmp_path / 'snapshot.parquet')
+    write_snapshot(processed, 'v1', path, processing=PROCESSING_VERSION)
+    snapshot, meta = read_snapshot(path)
+    pd.testing.assert_frame_equal(snapshot, processed)
+    assert meta['processing'] == PROCESSING_VERSION
+
+    processor = LeadsProcessor()
+    processor.adopt(snapshot, sync.frame, delta)
+    # Appended rows without gaps come back as integer postcodes
+    sheet.append(new_leads(sheet.read(), 10).dropna(subset=['Postleitzahl']).astype({'Postleitzahl': int}))
+    assert_matches_full_run(processor, sync, sync.sync())
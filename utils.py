@@ -1,6 +1,7 @@
 import pandas as pd
 import streamlit as st
 from datetime import datetime
+from sheets import SheetChangedError
 
 
 def format_fig_layout(fig):
@@ -124,48 +125,48 @@ def format_date(date_value):
 
 
 def save_data(new_data, conn):
-    existing_data = conn.read(worksheet='leads')
-    existing_df = pd.DataFrame(existing_data)
-
+    """
+    Upserts the given leads by 'Id'. Only their rows are written to the sheet
+    and merged into the local copy kept by `conn` (the app's LeadsSync).
+    """
     new_data_df = pd.DataFrame(new_data)
-    common_columns = existing_df.columns.intersection(new_data_df.columns)
-    filtered_new_data = new_data_df[common_columns]
-
-    for col in existing_df.columns:
-        if col not in filtered_new_data.columns:
-            filtered_new_data[col] = pd.NA
-    combined_data = pd.concat([existing_df, filtered_new_data], ignore_index=True)
-    combined_data.drop_duplicates(subset='Id', keep='last', inplace=True)
+    try:
+        conn.upsert(new_data_df)
+    except SheetChangedError:
+        st.error("The sheet changed while saving, please try again.")
+        return
 
-    conn.update(data=combined_data, worksheet='leads')
     st.success("Data Updated successfully!")
-    st.cache_data.clear()
+    st.session_state['refresh_requested'] = True
 
     # conn.update(data=df, worksheet='leads')
     # df.to_csv("data/df.csv", index=False)
 
 
 def drop_lead(df, conn):
+    """
+    Deletes the given leads by 'Id'. Only their rows are removed from the sheet
+    and from the local copy kept by `conn` (the app's LeadsSync).
+    """
     if not isinstance(df, pd.DataFrame) or df.shape[0] < 1:
         st.error("The DataFrame must contain at least one lead.")
         return
-    existing_data = conn.read(worksheet='leads')
-    existing_df = pd.DataFrame(existing_data)
 
     if 'Id' not in df.columns:
         st.error("The provided leads must contain an 'Id' field.")
         return
 
     ids_to_drop = df['Id'].unique()
-    ids_present = existing_df[existing_df['Id'].isin(ids_to_drop)]
-
-    if ids_present.empty:
+    try:
+        deleted = conn.delete(ids_to_drop)
+    except SheetChangedError:
+        st.error("The sheet changed while deleting, please try again.")
+        return
+    if deleted == 0:
         st.error("The specified lead is not present in the existing data.")
     else:
-        updated_df = existing_df[~existing_df['Id'].isin(ids_present['Id'])]
-        conn.update(data=updated_df, worksheet='leads')
         st.success("Lead record deleted successfully!")
-    st.cache_data.clear()
+    st.session_state['refresh_requested'] = True
 
 
 def lead_feats_metrics(df):
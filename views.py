@@ -3,8 +3,10 @@ import csv
 import numpy as np
 import pandas as pd
 import streamlit as st
-from data_processing import process_data
+from data_processing import plain_dtypes, process_data
 from filters import get_filters_and_data, get_lead_feature_filters, lead_feature_filters
+from search import get_lead_lookup, search_leads
+from spatial_index import nearby_leads
 from streamlit_folium import folium_static
 from plots import leads_by_location, property_type_breakdown, property_units_breakdown, leads_treemap, \
     residential_units_pie_chart, commercial_units_pie_chart, lead_count_pie_chart, property_condition_map, \
@@ -17,6 +19,9 @@ from utils import get_lead_info, display_lead_metrics, \
     get_lead_location_info, format_date, save_data, lead_feats_metrics, drop_lead
 from css.streamlit_ui import feature_html
 
+# Radii offered by the nearby leads panel
+NEARBY_RADII_KM = [5, 10, 25, 50, 100]
+
 
 def summary_view(data):
     df = get_filters_and_data(data)
@@ -130,10 +135,11 @@ def geographic_analytics_view(data):
 
 
 
-def display_lead_info(filtered_data):
+def display_lead_info(filtered_data, sort=True):
     st.write("#### ")
     if not filtered_data.empty:
-        filtered_data = filtered_data.sort_values(by=['Email', 'Id'])
+        if sort:
+            filtered_data = filtered_data.sort_values(by=['Email', 'Id'])
         for lead_email in filtered_data['Email'].unique():
             temp_df = filtered_data[filtered_data['Email'] == lead_email]
             name, email, phone = get_lead_info(temp_df)
@@ -175,6 +181,31 @@ def display_property_info(row, idx):
             st.write(field_value if not pd.isnull(field_value) else "No Info")
 
     display_property_details(row)
+    display_nearby_leads(row, idx)
+
+
+def display_nearby_leads(row, idx):
+    """
+    Lists the other leads around the property, within the picked radius or,
+    when there are none, the nearest ones. The lookup only runs once the panel
+    is switched on.
+    """
+    if not st.toggle("Nearby Leads 🧭", key=f"nearby_{idx}"):
+        return
+    if pd.isnull(row['lat']):
+        st.write("No coordinates known for this postcode.")
+        return
+    radius = st.select_slider("Radius (km)", options=NEARBY_RADII_KM, value=10, key=f"nearby_radius_{idx}")
+    nearby = nearby_leads(st.session_state['data'], row, radius_km=radius)
+    if nearby.empty:
+        st.write("No other leads with known coordinates.")
+        return
+    if nearby['Distance (km)'].iloc[0] > radius:
+        st.caption(f"No leads within {radius} km, nearest leads:")
+    nearby = nearby.assign(Name=nearby['Vorname'].astype(str) + ' ' + nearby['Nachname'].astype(str))
+    st.dataframe(nearby[['Id', 'Name', 'Postleitzahl', 'Ort', 'Objekttyp', 'Grundstueckflaeche', 'Distance (km)']],
+                 hide_index=True, use_container_width=True)
+
 
 def display_property_details(row):
     property_type = 'No Info' if pd.isnull(row['Objekttyp']) else row['Objekttyp']
@@ -198,9 +229,36 @@ def display_property_details(row):
     row_2[2].plotly_chart(property_condition_map(row), use_container_width=True)
 
 
+def lead_picker(columns, data, default_id=None):
+    """
+    Looks a lead up by name, email, phone or Id as the user types, instead of
+    listing every lead in a selectbox. Returns the picked Id, or `default_id`
+    while nothing is typed.
+    """
+    query = columns[0].text_input("Find Lead", placeholder="Name, email, phone or Id")
+    if query:
+        matches = data.iloc[get_lead_lookup(data).search(query, limit=20)]
+    else:
+        matches = data[data['Id'] == default_id]
+    labels = {lead.Id: f"{lead.Id} · {lead.Vorname} {lead.Nachname} · {lead.Email}"
+              for lead in matches[['Id', 'Vorname', 'Nachname', 'Email']].itertuples(index=False)}
+    return columns[1].selectbox("Lead", options=list(labels), format_func=labels.get)
+
+
 def features_view(data):
-    filtered_data = get_lead_feature_filters(data)
-    display_lead_info(filtered_data)
+    search_cols = st.columns((2, 1, 2))
+    query = search_cols[0].text_input("Search", placeholder="Search messages, property descriptions, defects ...")
+    lead_id = lead_picker(search_cols[1:], data)
+    if lead_id is not None:
+        display_lead_info(data[data['Id'] == lead_id])
+    elif query:
+        filtered_data = search_leads(data, query)
+        st.caption(f"{len(filtered_data)} best matching properties")
+        # Keep the ranking: leads are listed in the order of their best match
+        display_lead_info(filtered_data, sort=False)
+    else:
+        filtered_data = get_lead_feature_filters(data)
+        display_lead_info(filtered_data)
 
 def updatedata_view(data, conn):
     data_fields = st.session_state['fields']
@@ -250,12 +308,16 @@ def updatedata_view(data, conn):
         else:
             row_1[2].error("The provided data file does not contain sufficient information.")
             lead_data = data[data['Id'] == data['Id'].min()]
-            ids_list = sorted(list(data['Id'].unique()))
+            ids_list = None
     else:
-        ids_list = sorted(list(data['Id'].unique()))
+        ids_list = None
 
-    row_2 = st.columns((1, 5))
-    lead_id = row_2[0].selectbox(label="Lead Id", options=ids_list, index=ids_list.index(lead_data['Id'].iloc[0]))
+    if ids_list is None:
+        lead_id = lead_picker(st.columns((1, 2, 3)), data, default_id=lead_data['Id'].iloc[0])
+    else:
+        # Ids of the uploaded file
+        row_2 = st.columns((1, 5))
+        lead_id = row_2[0].selectbox(label="Lead Id", options=ids_list, index=ids_list.index(lead_data['Id'].iloc[0]))
 
     st.session_state['lead_data'] = data[data['Id'] == lead_id][data_fields]
     # Display form and lead data
@@ -320,7 +382,7 @@ def update_form(data, lead_data, lead_id, conn):
             gewerbeeinheiten = prop_info[0].number_input("Gewerbeeinheiten", min_value=0, value=int(record['Gewerbeeinheiten']), step=1, help="Number of commercial units in the property.")
             grundstuecksflaeche = prop_info[1].number_input("Grundstücksfläche", min_value=0.0, value=record['Grundstueckflaeche'], step=1.0, help="Total land or lot area (in square meters).")
             zimmeranzahl = prop_info[2].number_input("Zimmeranzahl", min_value=0, value=int(record['Zimmeranzahl']), step=1, help="Number of rooms.")
-            etagenanzahl = prop_info[3].number_input("Etagenanzahl", min_value=0.0, value=record['Etagenanzahl'], step=1.0, help="Number of floors.")
+            etagenanzahl = prop_info[3].number_input("Etagenanzahl", min_value=0.0, value=float(record['Etagenanzahl']), step=1.0, help="Number of floors.")
 
         # Expander for Property Address
         with st.expander("Property Features"):
@@ -437,6 +499,8 @@ def update_form(data, lead_data, lead_id, conn):
             'Mieteinnahmen (Kaltmiete)': kaltmiete,
             'Informationen zu besonderen Rechten': rechten,
         }
+        # The form may set values that are not categories of the shared frame yet
+        lead_data = plain_dtypes(lead_data)
         for col, value in updates.items():
             lead_data.loc[lead_data['Id'] == lead_id, col] = value
         st.session_state['lead_data'] = lead_data